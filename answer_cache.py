@@ -0,0 +1,346 @@
+from autogen_agentchat.messages import (
+    ModelClientStreamingChunkEvent,
+    TextMessage,
+    ToolCallExecutionEvent,
+    ToolCallRequestEvent,
+)
+from autogen_core import CancellationToken
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.indexes.aio import SearchIndexClient
+from collections import OrderedDict
+from figure_store import FigureStore, StoredFigure
+from local_index import LOCAL_INDEX
+from preview import clear_previews
+from prewarm import SEARCH_HISTORY
+from search_cache import SEARCH_RESULT_CACHE
+from search_client_pool import SEARCH_CLIENT_POOL
+from search_results import SearchResultRegistry
+from settings import load_environment
+from typing import AsyncIterator
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+
+ANSWER_AGENTS = ("answer_agent", "revise_answer_agent")
+
+
+class IndexVersion:
+    """Tracks a stamp identifying the index contents answers were generated from.
+
+    AnswerCache__IndexVersion wins when set, so a deployment that re-indexes can
+    bump it. Otherwise the local index's snapshot version is used, or for the
+    live index a stamp of its ETag, document count and storage size. The ETag
+    only changes with the index definition, so the statistics are included to
+    notice documents being re-indexed.
+
+    Until a stamp has been read the version is None and answers are not cached.
+
+    Args:
+        check_interval (float, optional): Seconds between checks of the live index.
+            Defaults to AnswerCache__VersionCheckInterval, or 300.
+    """
+
+    def __init__(self, check_interval: float = None):
+        if check_interval is None:
+            check_interval = float(
+                os.environ.get("AnswerCache__VersionCheckInterval", 300)
+            )
+
+        self.check_interval = check_interval
+        self.remote: str | None = None
+
+    @property
+    def current(self) -> str | None:
+        version = os.environ.get("AnswerCache__IndexVersion")
+        if version:
+            return version
+
+        if LOCAL_INDEX is not None:
+            return LOCAL_INDEX.version
+
+        return self.remote
+
+    async def fetch_remote(self) -> str:
+        """Read the stamp of the live index."""
+        async with SearchIndexClient(
+            endpoint=os.environ["AIService__AzureSearchOptions__Endpoint"],
+            credential=AzureKeyCredential(
+                os.environ["AIService__AzureSearchOptions__Key"]
+            ),
+        ) as client:
+            index = await client.get_index(SEARCH_CLIENT_POOL.index_name)
+            statistics = await client.get_index_statistics(
+                SEARCH_CLIENT_POOL.index_name
+            )
+
+        return "{}:{}:{}".format(
+            index.e_tag, statistics["document_count"], statistics["storage_size"]
+        )
+
+    async def check(self) -> None:
+        """Refresh the stamp, dropping everything derived from the index if it moved."""
+        if os.environ.get("AnswerCache__IndexVersion"):
+            return
+
+        if LOCAL_INDEX is not None:
+            # Reloading a replaced snapshot invalidates through its callbacks
+            await LOCAL_INDEX.refresh()
+            return
+
+        version = await self.fetch_remote()
+        if self.remote is not None and version != self.remote:
+            logging.info("Index changed from %s to %s", self.remote, version)
+            invalidate_index()
+
+        self.remote = version
+
+    async def watch(self) -> None:
+        """Check the stamp every check interval until cancelled."""
+        while True:
+            try:
+                await self.check()
+            except Exception:
+                # Keep the last stamp, a transient failure is not a change
+                logging.exception("Unable to read the index version")
+
+            await asyncio.sleep(self.check_interval)
+
+
+class CachedAnswer:
+    """A recorded turn: the search requests, retrievals and final answers."""
+
+    __slots__ = ("messages", "search_results", "figures", "created_at")
+
+    def __init__(
+        self,
+        messages: list,
+        search_results: SearchResultRegistry,
+        figures: dict[str, dict[str, StoredFigure]],
+    ):
+        self.messages = messages
+        self.search_results = search_results
+        self.figures = figures
+        self.created_at = time.monotonic()
+
+    async def replay(
+        self, figure_store: FigureStore, token_delay: float = 0.0
+    ) -> AsyncIterator:
+        """Replay the turn as the team's message stream.
+
+        Answers are streamed again word by word, so they render exactly as a live
+        answer does.
+
+        Args:
+            figure_store (FigureStore): Store to restore the referenced figures to.
+            token_delay (float, optional): Delay between streamed words. Defaults to 0.
+        """
+        for chunk_id, figures in self.figures.items():
+            figure_store.add_figures(chunk_id, figures)
+
+        for message in self.messages:
+            if isinstance(message, TextMessage):
+                for token in re.findall(r"\S+\s*|\s+", message.content):
+                    yield ModelClientStreamingChunkEvent(
+                        content=token, source=message.source
+                    )
+                    await asyncio.sleep(token_delay)
+
+            yield message
+
+
+class AnswerRecorder:
+    """Records a team's message stream so the turn can be cached."""
+
+    def __init__(self, search_results: SearchResultRegistry, figure_store: FigureStore):
+        self.source_results = search_results
+        self.figure_store = figure_store
+
+        self.messages = []
+        self.search_results = SearchResultRegistry()
+        self.figures: dict[str, dict[str, StoredFigure]] = {}
+        self.complete = False
+
+    def observe(self, message) -> None:
+        if isinstance(message, ToolCallRequestEvent):
+            self.messages.append(message)
+        elif isinstance(message, ToolCallExecutionEvent):
+            self.messages.append(message)
+
+            for result in message.content:
+                try:
+                    results = self.source_results.lookup(result.content)
+                except json.JSONDecodeError:
+                    continue
+
+                self.search_results.restore(result.content, results)
+                for chunk_id in results:
+                    figures = self.figure_store.get(chunk_id)
+                    if figures:
+                        self.figures[chunk_id] = dict(figures)
+        elif isinstance(message, TextMessage) and message.source in ANSWER_AGENTS:
+            self.messages.append(message)
+
+    async def record(self, stream: AsyncIterator) -> AsyncIterator:
+        """Pass the stream through, recording it."""
+        async for message in stream:
+            self.observe(message)
+            yield message
+
+        self.complete = True
+
+    def answer(self) -> CachedAnswer | None:
+        """The recorded turn, or None if it did not finish with an answer."""
+        answered = any(isinstance(message, TextMessage) for message in self.messages)
+        if not self.complete or not answered:
+            return None
+
+        return CachedAnswer(self.messages, self.search_results, self.figures)
+
+
+class AnswerCache:
+    """LRU cache of answered turns keyed by question, agent mode and index version.
+
+    Each team resets its conversation every turn, so a turn depends only on the
+    question and the mode, and a cached turn can be replayed for any session."""
+
+    def __init__(
+        self,
+        enabled: bool = None,
+        max_entries: int = None,
+        ttl: float = None,
+        token_delay: float = None,
+    ):
+        if enabled is None:
+            enabled = os.environ.get("AnswerCache__Enabled", "false").lower() == "true"
+        if max_entries is None:
+            max_entries = int(os.environ.get("AnswerCache__MaxEntries", 256))
+        if ttl is None:
+            ttl = float(os.environ.get("AnswerCache__Ttl", 24 * 3600))
+        if token_delay is None:
+            token_delay = float(os.environ.get("AnswerCache__ReplayTokenDelay", 0))
+
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.token_delay = token_delay
+
+        self._entries: OrderedDict[tuple, CachedAnswer] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalise_question(question: str) -> str:
+        """Normalise the question so trivially different phrasings share an entry."""
+        return " ".join(question.lower().split()).rstrip("?!. ")
+
+    def make_key(self, question: str, mode: str) -> tuple:
+        return (self.normalise_question(question), mode, INDEX_VERSION.current)
+
+    def get(self, key: tuple) -> CachedAnswer | None:
+        # Without an index version a cached answer could be stale
+        if not self.enabled or key[-1] is None:
+            return None
+
+        answer = self._entries.get(key)
+        if answer is None or answer.created_at + self.ttl < time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return answer
+
+    def set(self, key: tuple, answer: CachedAnswer | None) -> None:
+        if not self.enabled or key[-1] is None or answer is None:
+            return
+
+        self._entries[key] = answer
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __contains__(self, key: tuple) -> bool:
+        answer = self._entries.get(key)
+        return answer is not None and answer.created_at + self.ttl >= time.monotonic()
+
+    def invalidate(self) -> None:
+        """Drop every cached answer."""
+        self._entries.clear()
+
+    async def warm(self, questions: list[str], modes: list[str] = None) -> None:
+        """Answer the questions in the background so they are cached.
+
+        Args:
+            questions (list[str]): The questions, e.g. the chat starters.
+            modes (list[str], optional): The agent modes to answer in. Defaults to
+                AnswerCache__WarmModes, or both modes."""
+        # Imported here as the teams import this module's dependencies
+        from team_manager import TeamManager
+
+        if not self.enabled:
+            return
+
+        if INDEX_VERSION.current is None:
+            await INDEX_VERSION.check()
+
+        if modes is None:
+            modes = os.environ.get(
+                "AnswerCache__WarmModes", "RAG Agent,RAT Agent"
+            ).split(",")
+
+        team_manager = TeamManager()
+
+        for mode in modes:
+            for question in questions:
+                mode = mode.strip()
+                key = self.make_key(question, mode)
+                if key in self:
+                    continue
+
+                team = await team_manager.team_for_turn(mode)
+                if team is None:
+                    continue
+
+                recorder = AnswerRecorder(
+                    team.search_results, team.figure_and_chunk_pairs
+                )
+                try:
+                    async for _ in recorder.record(
+                        team.run_stream(
+                            task=[TextMessage(content=question, source="user")],
+                            cancellation_token=CancellationToken(),
+                        )
+                    ):
+                        pass
+                except Exception:
+                    logging.exception("Unable to warm the answer to %s", question)
+                    continue
+
+                self.set(key, recorder.answer())
+                SEARCH_HISTORY.record(question, mode, team.search_tool.searches)
+
+        logging.info("Answer cache warmed with %d answers", len(self._entries))
+
+    @property
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def invalidate_index() -> None:
+    """Drop everything derived from the index. Call this when the index changes."""
+    ANSWER_CACHE.invalidate()
+    SEARCH_RESULT_CACHE.invalidate()
+    clear_previews()
+
+
+load_environment()
+INDEX_VERSION = IndexVersion()
+ANSWER_CACHE = AnswerCache()
+
+if LOCAL_INDEX is not None:
+    LOCAL_INDEX.on_reload.append(ANSWER_CACHE.invalidate)
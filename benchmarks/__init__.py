@@ -0,0 +1,7 @@
+"""Offline benchmarks for the Rag and Rat pipelines.
+
+The stand-ins in `benchmarks.fakes` replace Azure Search and Azure OpenAI, so
+the benchmarks run on any machine without credentials:
+
+    python -m benchmarks.replay --mode rat --iterations 5
+"""
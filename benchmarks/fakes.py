@@ -0,0 +1,254 @@
+from autogen_core import CancellationToken, FunctionCall
+from autogen_core.models import (
+    ChatCompletionClient,
+    CreateResult,
+    LLMMessage,
+    ModelInfo,
+    RequestUsage,
+    SystemMessage,
+)
+from autogen_core.tools import Tool, ToolSchema
+from io import BytesIO
+from typing import Any, AsyncGenerator, Callable, Mapping, Sequence
+import PIL.Image
+import asyncio
+import base64
+import json
+import numpy as np
+import re
+import zlib
+
+# A reply is either text or the tool calls to make
+Reply = str | list[FunctionCall]
+
+
+def slug(text: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", text.lower()).strip("-")
+
+
+def synthetic_figure(seed: int, width: int = 1024, height: int = 768) -> str:
+    """Render a base64 PNG chart-like figure with enough detail to cost a real decode."""
+    generator = np.random.default_rng(seed)
+
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    noise = generator.normal(0, 24, (height, width, 3))
+    pixels = np.clip(gradient + noise + seed * 17 % 96, 0, 255).astype(np.uint8)
+
+    buffer = BytesIO()
+    PIL.Image.fromarray(pixels, "RGB").save(buffer, format="PNG")
+
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+class FakeSearchClient:
+    """Stand-in for the async Azure SearchClient that serves recorded results.
+
+    Recordings map a search term to the raw index results for it, in the shape
+    the index returns: ChunkId, Title, Chunk, ChunkFigures and
+    @search.reranker_score. Terms missing from the recording get deterministic
+    synthetic results, so speculative and rewritten queries still resolve."""
+
+    def __init__(
+        self,
+        recording: dict[str, list[dict]],
+        latency: float = 0.15,
+        figures: int = 8,
+        chunk_words: int = 300,
+        figure_size: tuple[int, int] = (1024, 768),
+    ):
+        self.recording = recording
+        self.latency = latency
+        self.chunk_words = chunk_words
+        self.figures = [synthetic_figure(seed, *figure_size) for seed in range(figures)]
+        self.calls: list[tuple[str, int]] = []
+
+    def synthesise(self, search_text: str, top: int) -> list[dict]:
+        seed = zlib.crc32(search_text.encode("utf-8"))
+        generator = np.random.default_rng(seed)
+        vocabulary = re.findall(r"\w+", search_text.lower()) + [
+            f"term{index}" for index in range(500)
+        ]
+
+        results = []
+        for index in range(top):
+            words = generator.choice(vocabulary, self.chunk_words)
+            figure = self.figures[(seed + index) % len(self.figures)]
+            results.append(
+                {
+                    "ChunkId": f"{slug(search_text)}-{index}",
+                    "Title": search_text.title(),
+                    "Chunk": f"## {search_text.title()}\n\n"
+                    + " ".join(words)
+                    + "\n\n<figure FigureId='1'>",
+                    "ChunkFigures": [{"FigureId": "1", "Data": figure}],
+                    "@search.reranker_score": 3.5 - 0.2 * index,
+                }
+            )
+
+        return results
+
+    async def search(
+        self, search_text: str, top: int, skip: int = 0, **kwargs
+    ) -> "FakeResults":
+        self.calls.append((search_text, top))
+        await asyncio.sleep(self.latency)
+
+        results = self.recording.get(search_text)
+        if results is None:
+            results = self.synthesise(search_text, skip + top)
+
+        return FakeResults(results[skip : skip + top])
+
+    async def close(self) -> None:
+        pass
+
+
+class FakeResults:
+    """Async iterable over search results, as returned by the aio SearchClient."""
+
+    def __init__(self, results: list[dict]):
+        self.results = results
+
+    async def __aiter__(self):
+        for result in self.results:
+            yield result
+
+
+class ScriptedChatCompletionClient(ChatCompletionClient):
+    """Stand-in chat completion client that replies from a script.
+
+    The script picks the reply for each request, so one client can serve every
+    agent sharing a model. Streamed replies are split into word tokens and
+    emitted with a first token delay and a per token delay.
+
+    Args:
+        script (Callable): Maps the request messages and tool names to the reply.
+        latency (float, optional): Delay before a non-streamed reply. Defaults to 0.3.
+        first_token_delay (float, optional): Delay before the first streamed token. Defaults to 0.3.
+        token_delay (float, optional): Delay between streamed tokens. Defaults to 0.01.
+    """
+
+    def __init__(
+        self,
+        script: Callable[[Sequence[LLMMessage], set[str]], Reply],
+        latency: float = 0.3,
+        first_token_delay: float = 0.3,
+        token_delay: float = 0.01,
+    ):
+        self.script = script
+        self.latency = latency
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+
+        self._model_info = ModelInfo(
+            vision=True, function_calling=True, json_output=True, family="gpt-4o"
+        )
+        self._total_usage = RequestUsage(prompt_tokens=0, completion_tokens=0)
+        self._actual_usage = RequestUsage(prompt_tokens=0, completion_tokens=0)
+        self.calls = 0
+
+    @staticmethod
+    def tool_names(tools: Sequence[Tool | ToolSchema]) -> set[str]:
+        return {tool["name"] if isinstance(tool, dict) else tool.name for tool in tools}
+
+    def reply(
+        self, messages: Sequence[LLMMessage], tools: Sequence[Tool | ToolSchema]
+    ) -> Reply:
+        self.calls += 1
+        return self.script(messages, self.tool_names(tools))
+
+    def usage(self, messages: Sequence[LLMMessage], content: Reply) -> RequestUsage:
+        usage = RequestUsage(
+            prompt_tokens=self.count_tokens(messages),
+            completion_tokens=len(str(content)) // 4,
+        )
+        self._actual_usage = usage
+        self._total_usage = RequestUsage(
+            prompt_tokens=self._total_usage.prompt_tokens + usage.prompt_tokens,
+            completion_tokens=self._total_usage.completion_tokens
+            + usage.completion_tokens,
+        )
+
+        return usage
+
+    async def create(
+        self,
+        messages: Sequence[LLMMessage],
+        *,
+        tools: Sequence[Tool | ToolSchema] = [],
+        json_output: bool | None = None,
+        extra_create_args: Mapping[str, Any] = {},
+        cancellation_token: CancellationToken | None = None,
+    ) -> CreateResult:
+        content = self.reply(messages, tools)
+        await asyncio.sleep(self.latency)
+
+        return CreateResult(
+            finish_reason="function_calls" if isinstance(content, list) else "stop",
+            content=content,
+            usage=self.usage(messages, content),
+            cached=False,
+        )
+
+    async def create_stream(
+        self,
+        messages: Sequence[LLMMessage],
+        *,
+        tools: Sequence[Tool | ToolSchema] = [],
+        json_output: bool | None = None,
+        extra_create_args: Mapping[str, Any] = {},
+        cancellation_token: CancellationToken | None = None,
+    ) -> AsyncGenerator[str | CreateResult, None]:
+        content = self.reply(messages, tools)
+
+        if isinstance(content, list):
+            await asyncio.sleep(self.latency)
+        else:
+            await asyncio.sleep(self.first_token_delay)
+            for index, token in enumerate(re.findall(r"\S+\s*", content)):
+                if index:
+                    await asyncio.sleep(self.token_delay)
+                yield token
+
+        yield CreateResult(
+            finish_reason="function_calls" if isinstance(content, list) else "stop",
+            content=content,
+            usage=self.usage(messages, content),
+            cached=False,
+        )
+
+    def actual_usage(self) -> RequestUsage:
+        return self._actual_usage
+
+    def total_usage(self) -> RequestUsage:
+        return self._total_usage
+
+    def count_tokens(
+        self, messages: Sequence[LLMMessage], *, tools: Sequence[Tool | ToolSchema] = []
+    ) -> int:
+        return sum(len(str(message.content)) for message in messages) // 4
+
+    def remaining_tokens(
+        self, messages: Sequence[LLMMessage], *, tools: Sequence[Tool | ToolSchema] = []
+    ) -> int:
+        return 128000 - self.count_tokens(messages)
+
+    @property
+    def capabilities(self) -> ModelInfo:
+        return self._model_info
+
+    @property
+    def model_info(self) -> ModelInfo:
+        return self._model_info
+
+
+def system_message(messages: Sequence[LLMMessage]) -> str:
+    for message in messages:
+        if isinstance(message, SystemMessage):
+            return message.content
+
+    return ""
+
+
+def tool_call(name: str, arguments: dict) -> list[FunctionCall]:
+    return [FunctionCall(id=f"call-{name}", name=name, arguments=json.dumps(arguments))]
@@ -0,0 +1,412 @@
+"""Drive demo.chat with many simulated sessions and measure it under load.
+
+Each session opens a Chainlit HTTP context, runs the chat start handler and
+asks the scenario question for a number of turns, with Azure Search and Azure
+OpenAI replaced by the stand-ins in `benchmarks.fakes`. Concurrency is ramped
+through the given levels, then optionally held at the last level for a soak.
+
+For each level it reports the turn latency percentiles, the event loop lag,
+the RSS per session and the figure bytes retained by the figure store.
+
+Usage:
+    python -m benchmarks.load_test --concurrency 1,10,50 --turns 2
+    python -m benchmarks.load_test --concurrency 25 --soak 600 --figure-size 2048x1536
+"""
+
+from benchmarks.fakes import FakeSearchClient, ScriptedChatCompletionClient
+from benchmarks.replay import MODES, SCENARIO_PATH, Scenario
+from chainlit.context import init_http_context
+from chainlit.emitter import BaseChainlitEmitter
+from pathlib import Path
+import argparse
+import asyncio
+import chainlit as cl
+import chainlit.config
+import gc
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Nearest rank percentile, e.g. fraction 0.95 for the p95."""
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def rss_bytes() -> int:
+    """The resident set size of this process."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak rather than current RSS, in kilobytes on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class CountingEmitter(BaseChainlitEmitter):
+    """Stands in for the websocket, counting the frames and bytes sent to it."""
+
+    def __init__(self, session, counts: dict[str, int]):
+        super().__init__(session)
+        self.counts = counts
+
+    def count(self, content: str = "") -> None:
+        self.counts["frames"] += 1
+        self.counts["bytes"] += len(content or "")
+
+    async def send_step(self, step_dict) -> None:
+        self.count(step_dict.get("output"))
+
+    async def update_step(self, step_dict) -> None:
+        self.count(step_dict.get("output"))
+
+    async def stream_start(self, step_dict) -> None:
+        self.count(step_dict.get("output"))
+
+    async def send_token(
+        self, id: str, token: str, is_sequence=False, is_input=False
+    ) -> None:
+        self.count(token)
+
+    async def send_element(self, element_dict) -> None:
+        self.count()
+
+    def set_chat_settings(self, settings: dict) -> None:
+        # Called without awaiting by cl.ChatSettings, as on the websocket emitter
+        self.session.chat_settings = settings
+
+
+class LoopMonitor:
+    """Samples the event loop lag and the RSS while a level runs.
+
+    The lag is how late a sleep of `interval` seconds wakes up, so any code
+    holding the loop shows up in it."""
+
+    def __init__(self, interval: float = 0.01, rss_every: int = 20):
+        self.interval = interval
+        self.rss_every = rss_every
+        self.lags: list[float] = []
+        self.peak_rss = 0
+        self._task: asyncio.Task | None = None
+
+    async def run(self) -> None:
+        ticks = 0
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(time.perf_counter() - started - self.interval)
+
+            ticks += 1
+            if ticks % self.rss_every == 0:
+                self.peak_rss = max(self.peak_rss, rss_bytes())
+
+    def start(self) -> None:
+        self.lags = []
+        self.peak_rss = rss_bytes()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+        self.peak_rss = max(self.peak_rss, rss_bytes())
+
+
+class LoadTest:
+    """Runs simulated sessions against the demo handlers with the stand-ins installed."""
+
+    def __init__(
+        self,
+        scenario: Scenario,
+        agent: str,
+        search_latency: float,
+        model_latency: float,
+        first_token_delay: float,
+        token_delay: float,
+        figures: int,
+        figure_size: tuple[int, int],
+        chunk_words: int,
+        think_time: float,
+        cold: bool,
+        answer_cache: bool,
+    ):
+        # Imported here so the stand-ins are registered before any team is built
+        import models
+        from answer_cache import ANSWER_CACHE
+        from figure_store import FIGURE_STORE
+        from search_cache import SEARCH_RESULT_CACHE
+        from search_client_pool import SEARCH_CLIENT_POOL
+
+        self.scenario = scenario
+        self.agent = agent
+        self.think_time = think_time
+
+        self.search_client = FakeSearchClient(
+            {},
+            latency=search_latency,
+            figures=figures,
+            chunk_words=chunk_words,
+            figure_size=figure_size,
+        )
+        SEARCH_CLIENT_POOL.create_client = lambda: self.search_client
+
+        self.model_client = ScriptedChatCompletionClient(
+            scenario.respond,
+            latency=model_latency,
+            first_token_delay=first_token_delay,
+            token_delay=token_delay,
+        )
+        for role in models.MODEL_DEPLOYMENTS:
+            models.register_model_client(role, self.model_client)
+
+        # Every turn runs the pipeline unless replaying cached answers is wanted
+        ANSWER_CACHE.enabled = answer_cache
+        # The stand-in index has no version to read, so pin one
+        os.environ.setdefault("AnswerCache__IndexVersion", "load-test")
+        if cold:
+            # Nothing fits, so every query goes to the search stand-in
+            SEARCH_RESULT_CACHE.max_bytes = 0
+
+        self.figure_store = FIGURE_STORE
+        self.monitor = LoopMonitor()
+        self.counts = {"frames": 0, "bytes": 0}
+
+    async def run_session(self, turns: int) -> list[float]:
+        """Open a session, ask the question for each turn and close it.
+
+        Returns:
+            list[float]: The latency of each turn."""
+        import demo
+        from chainlit.user_session import user_sessions
+
+        context = init_http_context()
+        context.emitter = CountingEmitter(context.session, self.counts)
+
+        await demo.start_chat()
+        if self.agent != "RAG Agent":
+            await demo.handle_agent_update({"Agent": self.agent})
+
+        latencies = []
+        try:
+            for _ in range(turns):
+                # Spread the sessions out as real users would
+                await asyncio.sleep(random.uniform(0, self.think_time))
+
+                started = time.perf_counter()
+                await demo.chat(cl.Message(content=self.scenario.question))
+                latencies.append(time.perf_counter() - started)
+        finally:
+            await demo.end_chat()
+            user_sessions.pop(context.session.id, None)
+
+        return latencies
+
+    def retained_figure_bytes(self) -> int:
+        return self.figure_store.memory_bytes + self.figure_store.spilled_bytes
+
+    async def run_level(self, concurrency: int, turns: int) -> dict:
+        """Run `concurrency` sessions at once and measure them."""
+        gc.collect()
+        rss_before = rss_bytes()
+        frames_before = self.counts["frames"]
+
+        self.monitor.start()
+        started = time.perf_counter()
+
+        sessions = await asyncio.gather(
+            *[self.run_session(turns) for _ in range(concurrency)],
+            return_exceptions=True,
+        )
+
+        elapsed = time.perf_counter() - started
+        await self.monitor.stop()
+        gc.collect()
+
+        failures = [session for session in sessions if isinstance(session, Exception)]
+        for failure in failures[:3]:
+            logging.error("Session failed", exc_info=failure)
+
+        latencies = [
+            latency
+            for session in sessions
+            if not isinstance(session, Exception)
+            for latency in session
+        ]
+
+        return {
+            "sessions": concurrency,
+            "failed_sessions": len(failures),
+            "turns": len(latencies),
+            "turns_per_second": len(latencies) / elapsed,
+            "p50_seconds": percentile(latencies, 0.5),
+            "p95_seconds": percentile(latencies, 0.95),
+            "p99_seconds": percentile(latencies, 0.99),
+            "loop_lag_p99_seconds": percentile(self.monitor.lags, 0.99),
+            "loop_lag_max_seconds": max(self.monitor.lags, default=0.0),
+            "rss_bytes": rss_bytes(),
+            "peak_rss_per_session_bytes": (self.monitor.peak_rss - rss_before)
+            / concurrency,
+            "retained_figure_bytes": self.retained_figure_bytes(),
+            "frames_per_turn": (self.counts["frames"] - frames_before)
+            / max(len(latencies), 1),
+        }
+
+    async def run(
+        self, levels: list[int], turns: int, soak_seconds: float
+    ) -> list[dict]:
+        """Ramp through the concurrency levels, then soak at the last one."""
+        results = []
+
+        for concurrency in levels:
+            result = await self.run_level(concurrency, turns)
+            result["phase"] = "ramp"
+            results.append(result)
+            print(format_row(result), flush=True)
+
+        soak_started = time.perf_counter()
+        while time.perf_counter() - soak_started < soak_seconds:
+            result = await self.run_level(levels[-1], turns)
+            result["phase"] = "soak"
+            results.append(result)
+            print(format_row(result), flush=True)
+
+        return results
+
+
+# (title, result key, width, format)
+COLUMNS = [
+    ("phase", "phase", 5, ""),
+    ("sessions", "sessions", 8, "d"),
+    ("turns/s", "turns_per_second", 8, ".2f"),
+    ("p50 s", "p50_seconds", 7, ".2f"),
+    ("p95 s", "p95_seconds", 7, ".2f"),
+    ("p99 s", "p99_seconds", 7, ".2f"),
+    ("lag p99 ms", "loop_lag_p99_seconds", 10, ".1f"),
+    ("lag max ms", "loop_lag_max_seconds", 10, ".1f"),
+    ("RSS MB", "rss_bytes", 8, ".1f"),
+    ("MB/session", "peak_rss_per_session_bytes", 10, ".2f"),
+    ("figures MB", "retained_figure_bytes", 10, ".1f"),
+    ("frames/turn", "frames_per_turn", 11, ".1f"),
+    ("failed", "failed_sessions", 6, "d"),
+]
+
+
+def display_value(key: str, value):
+    """Show bytes in megabytes and the loop lag in milliseconds."""
+    if key.endswith("_bytes"):
+        return value / 1024 / 1024
+    if key.startswith("loop_lag"):
+        return value * 1000
+    return value
+
+
+def format_header() -> str:
+    return "  ".join(f"{title:>{width}}" for title, _, width, _ in COLUMNS)
+
+
+def format_row(result: dict) -> str:
+    return "  ".join(
+        f"{display_value(key, result[key]):>{width}{spec}}"
+        for _, key, width, spec in COLUMNS
+    )
+
+
+def parse_size(size: str) -> tuple[int, int]:
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=list(MODES), default="rag")
+    parser.add_argument(
+        "--concurrency",
+        default="1,5,10,25",
+        help="Comma separated concurrent session counts to ramp through.",
+    )
+    parser.add_argument("--turns", type=int, default=2, help="Turns per session.")
+    parser.add_argument(
+        "--soak",
+        type=float,
+        default=0,
+        help="Seconds to keep running the last level after the ramp.",
+    )
+    parser.add_argument("--scenario", type=Path, default=SCENARIO_PATH)
+    parser.add_argument("--search-latency", type=float, default=0.15)
+    parser.add_argument("--model-latency", type=float, default=0.3)
+    parser.add_argument("--first-token-delay", type=float, default=0.3)
+    parser.add_argument("--token-delay", type=float, default=0.01)
+    parser.add_argument(
+        "--figures", type=int, default=8, help="Distinct figures the index returns."
+    )
+    parser.add_argument("--figure-size", type=parse_size, default=(1024, 768))
+    parser.add_argument("--chunk-words", type=int, default=300)
+    parser.add_argument(
+        "--think-time",
+        type=float,
+        default=1.0,
+        help="Upper bound of the random pause before each turn.",
+    )
+    parser.add_argument(
+        "--cold",
+        action="store_true",
+        help="Disable the search result cache so every query reaches the index.",
+    )
+    parser.add_argument(
+        "--answer-cache",
+        action="store_true",
+        help="Let repeated questions replay from the answer cache.",
+    )
+    parser.add_argument("--json", type=Path, help="Write the results to this file.")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    load_test = LoadTest(
+        Scenario.load(arguments.scenario),
+        MODES[arguments.mode],
+        search_latency=arguments.search_latency,
+        model_latency=arguments.model_latency,
+        first_token_delay=arguments.first_token_delay,
+        token_delay=arguments.token_delay,
+        figures=arguments.figures,
+        figure_size=arguments.figure_size,
+        chunk_words=arguments.chunk_words,
+        think_time=arguments.think_time,
+        cold=arguments.cold,
+        answer_cache=arguments.answer_cache,
+    )
+
+    levels = [int(level) for level in arguments.concurrency.split(",")]
+
+    print(format_header())
+    with tempfile.TemporaryDirectory(prefix="load-test-files-") as files_directory:
+        # Chainlit writes every element a session sends under its files directory,
+        # so keep the figures the sessions send out of the working tree
+        chainlit.config.FILES_DIRECTORY = Path(files_directory)
+        results = asyncio.run(load_test.run(levels, arguments.turns, arguments.soak))
+
+    if arguments.json is not None:
+        with open(arguments.json, "w") as results_file:
+            json.dump(results, results_file, indent=4)
+        print(f"Results written to {arguments.json}")
+
+    return 1 if any(result["failed_sessions"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
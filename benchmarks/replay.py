@@ -0,0 +1,371 @@
+"""Replay a recorded conversation through the Rag and Rat teams and time it.
+
+Azure Search and Azure OpenAI are replaced by the stand-ins in
+`benchmarks.fakes`, so the numbers measure this code rather than the services.
+Results are compared against `benchmarks/baseline.json`.
+
+Usage:
+    python -m benchmarks.replay --mode rat --iterations 5
+    python -m benchmarks.replay --check
+    python -m benchmarks.replay --update-baseline
+"""
+
+from autogen_agentchat.messages import ModelClientStreamingChunkEvent, TextMessage
+from autogen_agentchat.base import TaskResult
+from autogen_core import CancellationToken
+from autogen_core.models import LLMMessage
+from benchmarks.fakes import (
+    FakeSearchClient,
+    Reply,
+    ScriptedChatCompletionClient,
+    system_message,
+    tool_call,
+)
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Sequence
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import sys
+import time
+import tracemalloc
+
+SCENARIO_PATH = Path(__file__).with_name("scenario.json")
+BASELINE_PATH = Path(__file__).with_name("baseline.json")
+
+MODES = {"rag": "RAG Agent", "rat": "RAT Agent"}
+
+
+class Scenario:
+    """The scripted conversation: the question, the agents' search terms and answers."""
+
+    def __init__(self, data: dict):
+        self.question = data["question"]
+        self.rag_search_term = data["rag_search_term"]
+        self.breadth_first_terms = data["breadth_first_terms"]
+        self.depth_first_terms = data["depth_first_terms"]
+        self.speculative_terms = data["speculative_terms"]
+        self.answer = data["answer"]
+        self.revised_answer = data["revised_answer"]
+
+    @classmethod
+    def load(cls, path: Path) -> "Scenario":
+        with open(path) as scenario_file:
+            return cls(json.load(scenario_file))
+
+    def respond(self, messages: Sequence[LLMMessage], tools: set[str]) -> Reply:
+        """Pick the reply for a model request from the agent making it."""
+        if "rag_search_index" in tools:
+            return tool_call("rag_search_index", {"search_term": self.rag_search_term})
+        if "rat_search_index_breadth_first" in tools:
+            return tool_call(
+                "rat_search_index_breadth_first",
+                {"search_terms": self.breadth_first_terms},
+            )
+        if "rat_search_index_depth_first" in tools:
+            return tool_call(
+                "rat_search_index_depth_first",
+                {"search_terms": self.depth_first_terms},
+            )
+
+        instructions = system_message(messages)
+        if "one search term per line" in instructions:
+            return "\n".join(self.speculative_terms)
+        if "revising" in instructions:
+            return self.revised_answer
+
+        return self.answer
+
+
+@contextmanager
+def count_json_parses() -> Iterator[list[int]]:
+    """Count the calls to json.loads made inside the block."""
+    counter = [0]
+    original = json.loads
+
+    def counting_loads(*args, **kwargs):
+        counter[0] += 1
+        return original(*args, **kwargs)
+
+    json.loads = counting_loads
+    try:
+        yield counter
+    finally:
+        json.loads = original
+
+
+def stage_metrics(events: list[tuple[float, str, bool]], started: float) -> dict:
+    """Derive the per-stage wall time and time to first token from the event log.
+
+    Args:
+        events (list[tuple[float, str, bool]]): (time, source, is streamed token) per message.
+        started (float): When the task was started.
+
+    Returns:
+        dict: The stage metrics."""
+    metrics = {}
+    stage_source = None
+    stage_started = started
+    last_event = started
+
+    for event_time, source, is_token in events:
+        if source == "user":
+            continue
+
+        if source != stage_source:
+            if stage_source is not None:
+                metrics[f"stage_{stage_source}_seconds"] = last_event - stage_started
+                stage_started = last_event
+            stage_source = source
+
+        if is_token:
+            metrics.setdefault(f"ttft_{source}_seconds", event_time - stage_started)
+            metrics.setdefault("ttft_seconds", event_time - started)
+
+        last_event = event_time
+
+    if stage_source is not None:
+        metrics[f"stage_{stage_source}_seconds"] = last_event - stage_started
+
+    return metrics
+
+
+class ReplayBenchmark:
+    """Drives a team through the scenario with the service stand-ins installed."""
+
+    def __init__(
+        self,
+        scenario: Scenario,
+        recording: dict[str, list[dict]],
+        search_latency: float,
+        model_latency: float,
+        first_token_delay: float,
+        token_delay: float,
+        warm_caches: bool = False,
+    ):
+        # Imported here so the stand-ins are registered before any team is built
+        import models
+        from figure_store import FIGURE_STORE
+        from image_preprocessing import FIGURE_PREPROCESSOR
+        from search_cache import SEARCH_RESULT_CACHE
+        from search_client_pool import SEARCH_CLIENT_POOL
+        from team_manager import TeamManager
+
+        self.scenario = scenario
+        self.warm_caches = warm_caches
+
+        self.search_client = FakeSearchClient(recording, latency=search_latency)
+        SEARCH_CLIENT_POOL.create_client = lambda: self.search_client
+
+        self.model_client = ScriptedChatCompletionClient(
+            scenario.respond,
+            latency=model_latency,
+            first_token_delay=first_token_delay,
+            token_delay=token_delay,
+        )
+        for role in models.MODEL_DEPLOYMENTS:
+            models.register_model_client(role, self.model_client)
+
+        self.figure_store = FIGURE_STORE
+        self.figure_preprocessor = FIGURE_PREPROCESSOR
+        self.search_cache = SEARCH_RESULT_CACHE
+        self.team_manager = TeamManager()
+
+    def reset_caches(self) -> None:
+        if self.warm_caches:
+            return
+
+        self.search_cache.invalidate()
+        self.figure_store.drop_decoded()
+        self.figure_preprocessor.clear()
+
+    async def run_once(self, mode: str) -> dict:
+        """Run the scenario once and measure it."""
+        self.reset_caches()
+
+        team = await self.team_manager.team_for_turn(MODES[mode])
+        task = [TextMessage(content=self.scenario.question, source="user")]
+
+        search_calls = len(self.search_client.calls)
+        model_calls = self.model_client.calls
+        decode_seconds = self.figure_store.decode_seconds
+        normalise_seconds = self.figure_preprocessor.normalise_seconds
+
+        events = []
+        with count_json_parses() as json_parses:
+            started = time.perf_counter()
+
+            async for message in team.run_stream(
+                task=task, cancellation_token=CancellationToken()
+            ):
+                if isinstance(message, TaskResult):
+                    continue
+
+                events.append(
+                    (
+                        time.perf_counter(),
+                        message.source,
+                        isinstance(message, ModelClientStreamingChunkEvent),
+                    )
+                )
+
+            finished = time.perf_counter()
+
+        metrics = {
+            "total_seconds": finished - started,
+            **stage_metrics(events, started),
+            "figure_decode_seconds": self.figure_store.decode_seconds - decode_seconds,
+            "figure_normalise_seconds": self.figure_preprocessor.normalise_seconds
+            - normalise_seconds,
+            "json_parses": json_parses[0],
+            "search_calls": len(self.search_client.calls) - search_calls,
+            "model_calls": self.model_client.calls - model_calls,
+        }
+
+        return metrics
+
+    async def measure_allocations(self, mode: str) -> int:
+        """Run the scenario under tracemalloc and return the peak bytes allocated.
+
+        This is a separate run as tracing slows everything else down."""
+        tracemalloc.start()
+        try:
+            baseline, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            await self.run_once(mode)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        return peak - baseline
+
+    async def run(self, mode: str, iterations: int, warmup: int) -> dict:
+        """Run the scenario repeatedly and return the median of each metric."""
+        for _ in range(warmup):
+            await self.run_once(mode)
+
+        runs = [await self.run_once(mode) for _ in range(iterations)]
+
+        summary = {
+            metric: statistics.median(run.get(metric, 0) for run in runs)
+            for metric in runs[0]
+        }
+        summary["allocated_bytes"] = await self.measure_allocations(mode)
+
+        return summary
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """List the metrics that regressed by more than the tolerance."""
+    regressions = []
+
+    for mode, metrics in results.items():
+        for metric, value in metrics.items():
+            expected = baseline.get(mode, {}).get(metric)
+            if expected is None:
+                continue
+
+            if value > expected * (1 + tolerance) and value - expected > 1e-3:
+                regressions.append(
+                    f"{mode} {metric}: {value:.4g} vs baseline {expected:.4g}"
+                )
+
+    return regressions
+
+
+def format_results(results: dict, baseline: dict) -> str:
+    lines = []
+    for mode, metrics in results.items():
+        lines.append(f"{mode}:")
+        for metric, value in metrics.items():
+            line = f"  {metric:<45} {value:>14.4f}"
+            expected = baseline.get(mode, {}).get(metric)
+            if expected:
+                line += f"  ({(value - expected) / expected:+.1%} vs baseline)"
+            lines.append(line)
+
+    return "\n".join(lines)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=[*MODES, "all"], default="all")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--scenario", type=Path, default=SCENARIO_PATH)
+    parser.add_argument(
+        "--recording",
+        type=Path,
+        help="JSON file mapping search terms to recorded index results. Terms not in the recording get synthetic results.",
+    )
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--search-latency", type=float, default=0.15)
+    parser.add_argument("--model-latency", type=float, default=0.3)
+    parser.add_argument("--first-token-delay", type=float, default=0.3)
+    parser.add_argument("--token-delay", type=float, default=0.01)
+    parser.add_argument(
+        "--warm-caches",
+        action="store_true",
+        help="Keep the search and figure caches between iterations.",
+    )
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Exit with an error if any metric regressed against the baseline.",
+    )
+    parser.add_argument("--update-baseline", action="store_true")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    recording = {}
+    if arguments.recording is not None:
+        with open(arguments.recording) as recording_file:
+            recording = json.load(recording_file)
+
+    benchmark = ReplayBenchmark(
+        Scenario.load(arguments.scenario),
+        recording,
+        search_latency=arguments.search_latency,
+        model_latency=arguments.model_latency,
+        first_token_delay=arguments.first_token_delay,
+        token_delay=arguments.token_delay,
+        warm_caches=arguments.warm_caches,
+    )
+
+    modes = list(MODES) if arguments.mode == "all" else [arguments.mode]
+
+    async def run_all() -> dict:
+        return {
+            mode: await benchmark.run(mode, arguments.iterations, arguments.warmup)
+            for mode in modes
+        }
+
+    results = asyncio.run(run_all())
+
+    baseline = {}
+    if arguments.baseline.exists():
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    print(format_results(results, baseline))
+
+    if arguments.update_baseline:
+        with open(arguments.baseline, "w") as baseline_file:
+            json.dump({**baseline, **results}, baseline_file, indent=4)
+        print(f"Baseline written to {arguments.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, arguments.tolerance)
+    if regressions:
+        print("Regressions:\n  " + "\n  ".join(regressions))
+
+    return 1 if arguments.check and regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+from collections import defaultdict
+import numpy as np
+import re
+import zlib
+
+# Mersenne prime used for the MinHash permutations. With a, b and the hash all
+# below it, a * hash + b stays below 2**63, so it cannot overflow uint64.
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+class SeenChunkIndex:
+    """Index of the chunks already retrieved in a conversation.
+
+    Chunks are matched exactly by ChunkId, and approximately by MinHash over word
+    shingles with locality sensitive hashing, so overlapping neighbouring chunks
+    are recognised as already seen."""
+
+    def __init__(
+        self,
+        num_permutations: int = 64,
+        bands: int = 16,
+        threshold: float = 0.7,
+        shingle_size: int = 5,
+        seed: int = 42,
+    ):
+        if num_permutations % bands != 0:
+            raise ValueError("num_permutations must be divisible by bands")
+
+        self.num_permutations = num_permutations
+        self.bands = bands
+        self.rows = num_permutations // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+
+        generator = np.random.default_rng(seed)
+        self._a = generator.integers(1, MERSENNE_PRIME, num_permutations, np.uint64)
+        self._b = generator.integers(0, MERSENNE_PRIME, num_permutations, np.uint64)
+
+        self.chunk_ids: set[str] = set()
+        self._signatures: dict[str, np.ndarray] = {}
+        self._buckets: defaultdict[tuple, set[str]] = defaultdict(set)
+
+    def signature(self, text: str) -> np.ndarray | None:
+        """Compute the MinHash signature of the text, or None if it is empty."""
+        words = re.findall(r"\w+", text.lower())
+        if not words:
+            return None
+
+        size = min(self.shingle_size, len(words))
+        shingles = {
+            " ".join(words[index : index + size])
+            for index in range(len(words) - size + 1)
+        }
+        hashes = (
+            np.array(
+                [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles],
+                dtype=np.uint64,
+            )
+            % MERSENNE_PRIME
+        )
+
+        permuted = (np.outer(self._a, hashes) + self._b[:, None]) % MERSENNE_PRIME
+
+        return permuted.min(axis=1)
+
+    def band_keys(self, signature: np.ndarray) -> list[tuple]:
+        return [
+            (band, signature[band * self.rows : (band + 1) * self.rows].tobytes())
+            for band in range(self.bands)
+        ]
+
+    def is_seen(self, chunk_id: str, text: str) -> bool:
+        """Check whether the chunk, or a near duplicate of it, has been seen."""
+        if chunk_id in self.chunk_ids:
+            return True
+
+        signature = self.signature(text)
+        if signature is None:
+            return False
+
+        candidates = set()
+        for key in self.band_keys(signature):
+            candidates |= self._buckets.get(key, set())
+
+        return any(
+            np.mean(self._signatures[candidate] == signature) >= self.threshold
+            for candidate in candidates
+        )
+
+    def add(self, chunk_id: str, text: str) -> None:
+        """Record a chunk as seen."""
+        if chunk_id in self.chunk_ids:
+            return
+
+        self.chunk_ids.add(chunk_id)
+
+        signature = self.signature(text)
+        if signature is None:
+            return
+
+        self._signatures[chunk_id] = signature
+        for key in self.band_keys(signature):
+            self._buckets[key].add(chunk_id)
+
+    def clear(self) -> None:
+        self.chunk_ids.clear()
+        self._signatures.clear()
+        self._buckets.clear()
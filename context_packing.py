@@ -0,0 +1,235 @@
+from figure_store import StoredFigure
+from functools import lru_cache
+from image_preprocessing import CompactImage, FigureSelection
+from settings import load_environment
+from typing import NamedTuple
+import logging
+import math
+import os
+import re
+import tiktoken
+
+# Default prompt budget for the retrieved context given to each answer agent
+DEFAULT_TOKEN_BUDGETS = {"answer_agent": 8000, "revise_answer_agent": 12000}
+
+
+# Characters per token used when the tiktoken encoding cannot be loaded
+APPROXIMATE_CHARACTERS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding() -> tiktoken.Encoding | None:
+    """Load the tiktoken encoding, or None if it is unavailable.
+
+    tiktoken downloads the encoding on first use, so an offline process falls
+    back to an approximate count rather than failing the answer agent's turn."""
+    try:
+        return tiktoken.get_encoding(
+            os.environ.get("ContextPacking__Encoding", "o200k_base")
+        )
+    except Exception:
+        logging.warning("Unable to load tiktoken encoding, approximating token counts")
+        return None
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Count the tokens in the text."""
+    encoding = get_encoding()
+
+    if encoding is None:
+        return math.ceil(len(text) / APPROXIMATE_CHARACTERS_PER_TOKEN)
+
+    return len(encoding.encode(text))
+
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    """Truncate the text to at most the given number of tokens."""
+    encoding = get_encoding()
+
+    if encoding is None:
+        return text[: tokens * APPROXIMATE_CHARACTERS_PER_TOKEN]
+
+    return encoding.decode(encoding.encode(text)[:tokens])
+
+
+def count_image_tokens(width: int, height: int) -> int:
+    """Estimate the tokens for a high detail image as OpenAI bills them."""
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def word_set(text: str) -> frozenset[str]:
+    return frozenset(re.findall(r"\w+", text.lower()))
+
+
+def token_budget(agent_name: str) -> int:
+    """Get the configured context token budget for an answer agent."""
+    load_environment()
+    return int(
+        os.environ.get(
+            f"ContextPacking__{agent_name}__TokenBudget",
+            DEFAULT_TOKEN_BUDGETS.get(agent_name, 8000),
+        )
+    )
+
+
+class ChunkCandidate(NamedTuple):
+    chunk_id: str
+    text: str
+    reranker_score: float | None
+    figures: list[StoredFigure]
+
+
+class PackedChunk(NamedTuple):
+    chunk_id: str
+    text: str
+    images: list[CompactImage]
+    figures: list[StoredFigure]
+    tokens: int
+    words: frozenset[str]
+
+
+class PackingReport:
+    """Tracks the context packed into one answer agent turn."""
+
+    def __init__(self, token_budget: int):
+        self.token_budget = token_budget
+        self.packed_tokens = 0
+        self.dropped_tokens = 0
+        self.packed_chunks = 0
+        self.dropped_chunks = 0
+        self.truncated_chunks = 0
+        self.selected_words: list[frozenset[str]] = []
+
+    @property
+    def remaining_tokens(self) -> int:
+        return max(0, self.token_budget - self.packed_tokens)
+
+    def novelty(self, words: frozenset[str]) -> float:
+        """How much of the text is not covered by content already packed."""
+        if not words:
+            return 0.0
+
+        overlap = 0.0
+        for selected in self.selected_words:
+            overlap = max(overlap, len(words & selected) / len(words | selected))
+
+        return 1.0 - overlap
+
+    def __str__(self) -> str:
+        return (
+            f"packed {self.packed_tokens}/{self.token_budget} tokens in "
+            f"{self.packed_chunks} chunks ({self.truncated_chunks} truncated), "
+            f"dropped {self.dropped_tokens} tokens in {self.dropped_chunks} chunks"
+        )
+
+
+class ContextPacker:
+    """Packs retrieved chunks and figures into a prompt token budget.
+
+    The chunks of every tool result in the turn are ranked together, so a later
+    search, such as the revise pass's depth first results, competes with the
+    earlier ones rather than getting what they leave. Chunks are taken greedily
+    by reranker score weighted by novelty against the content already packed,
+    so near-repeats of earlier chunks rank lower. The chunk that no longer fits
+    is truncated if enough budget remains, and the rest are dropped."""
+
+    def __init__(self, novelty_weight: float = 0.5, min_truncated_tokens: int = 64):
+        self.novelty_weight = novelty_weight
+        self.min_truncated_tokens = min_truncated_tokens
+
+    def value(self, candidate: ChunkCandidate, report: PackingReport) -> float:
+        score = candidate.reranker_score or 0.0
+        novelty = report.novelty(word_set(candidate.text))
+
+        return score * (1 - self.novelty_weight * (1 - novelty))
+
+    async def pack(
+        self,
+        tool_results: list[list[ChunkCandidate]],
+        figure_selection: FigureSelection,
+        report: PackingReport,
+    ) -> list[list[PackedChunk]]:
+        """Pack the candidates of the turn's tool results into the budget.
+
+        Args:
+            tool_results (list[list[ChunkCandidate]]): The retrieved chunks of each
+                tool result.
+            figure_selection (FigureSelection): The figures selected so far this turn.
+            report (PackingReport): The packing state for the turn.
+
+        Returns:
+            list[list[PackedChunk]]: The packed chunks of each tool result, in their
+                original order."""
+        # Candidates by their (tool result, position) so repeated chunks stay apart
+        remaining = {
+            (result_index, index): candidate
+            for result_index, candidates in enumerate(tool_results)
+            for index, candidate in enumerate(candidates)
+        }
+        packed = {}
+
+        while remaining:
+            position = max(remaining, key=lambda p: self.value(remaining[p], report))
+            candidate = remaining.pop(position)
+
+            text = candidate.text
+            tokens = count_tokens(text)
+
+            if tokens > report.remaining_tokens:
+                if report.remaining_tokens < self.min_truncated_tokens:
+                    report.dropped_tokens += tokens
+                    report.dropped_chunks += 1
+                    continue
+
+                text = truncate_to_tokens(text, report.remaining_tokens)
+                report.dropped_tokens += tokens - report.remaining_tokens
+                report.truncated_chunks += 1
+                tokens = report.remaining_tokens
+
+            report.packed_tokens += tokens
+
+            images = []
+            figures = []
+            for figure in candidate.figures:
+                normalised = await figure_selection.candidate(figure)
+                if normalised is None:
+                    continue
+
+                # Checked before the figure takes a slot in the selection
+                image_tokens = count_image_tokens(*normalised.image.image.size)
+                if image_tokens > report.remaining_tokens:
+                    report.dropped_tokens += image_tokens
+                    figure_selection.dropped += 1
+                    continue
+
+                report.packed_tokens += image_tokens
+                tokens += image_tokens
+                images.append(figure_selection.add(normalised))
+                figures.append(figure)
+
+            words = word_set(text)
+            report.selected_words.append(words)
+            report.packed_chunks += 1
+
+            packed[position] = PackedChunk(
+                candidate.chunk_id, text, images, figures, tokens, words
+            )
+
+        return [
+            [
+                packed[(result_index, index)]
+                for index in range(len(candidates))
+                if (result_index, index) in packed
+            ]
+            for result_index, candidates in enumerate(tool_results)
+        ]
+
+
+CONTEXT_PACKER = ContextPacker()
@@ -1,4 +1,4 @@
-from typing import List
+from typing import AsyncIterator, List
 import json
 import chainlit as cl
 from autogen_agentchat.messages import (
@@ -8,45 +8,64 @@ from autogen_agentchat.messages import (
     ToolCallExecutionEvent,
     TextMessage,
 )
+from answer_cache import ANSWER_CACHE, INDEX_VERSION, AnswerRecorder, invalidate_index
 from autogen_core import CancellationToken
-from rag import Rag
-from rat import Rat
-import re
+from team_manager import TeamManager
 from chainlit.input_widget import Select
-from figure_processing import get_figures_from_chunk
-
-
-def remove_markdown_formatting(text: str) -> str:
-    """Remove Markdown formatting from text.
-
-    Args:
-        text (str): Text to remove formatting from.
-
-    Returns:
-        str: Text with formatting removed."""
-    # Remove bold and italic markers while keeping the text inside
-    text = re.sub(r"(\*\*|__)(.*?)\1", r"\2", text)  # **bold** or __bold__
-    text = re.sub(r"(\*|_)(.*?)\1", r"\2", text)  # *italic* or _italic_
-
-    # Remove inline code formatting
-    text = re.sub(r"`(.+?)`", r"\1", text)
-
-    # Remove other Markdown characters while keeping content
-    text = re.sub(r"!\[.*?\]\(.*?\)", "", text)  # Remove images
-    text = re.sub(r"\[([^\]]+)\]\(.*?\)", r"\1", text)  # Convert links to plain text
-    text = re.sub(r"^\#{1,6}\s*", "", text, flags=re.MULTILINE)  # Remove headers
-    text = re.sub(r"^\>\s?", "", text, flags=re.MULTILINE)  # Remove blockquotes
-    text = re.sub(
-        r"^\s*[-+*]\s+", "", text, flags=re.MULTILINE
-    )  # Remove unordered list markers
-    text = re.sub(
-        r"^\s*\d+\.\s+", "", text, flags=re.MULTILINE
-    )  # Remove ordered list markers
-
-    # Replace all new lines with a space
-    text = re.sub(r"\n", " ", text)
-
-    return text
+from figure_store import FigureStore
+from figure_processing import get_figure, get_figures_from_chunk, strip_figure_tags
+from figure_stream import FigureTag, FigureTagParser
+from preview import chunk_preview
+from prewarm import PREWARMER, SEARCH_HISTORY
+from search_results import SearchResultRegistry
+from session_state import SESSION_STATE
+from streaming import CoalescingStreamer
+from search_client_pool import SEARCH_CLIENT_POOL
+from tracing import TRACER
+from chainlit.server import app
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+import asyncio
+import hmac
+import os
+import time
+
+STARTER_QUESTIONS = [
+    "What is the approach for sustainability?",
+    "What priority areas will have the most impact on the business and it's stakeholders?",
+    "How is Shein innovating?",
+    "How does Shein enforce compliance throughput the supply chain?",
+    "What is Shein doing to be more sustainable?",
+]
+
+
+async def metrics(request: Request) -> PlainTextResponse:
+    """Expose the aggregated trace spans for Prometheus to scrape."""
+    return PlainTextResponse(
+        TRACER.prometheus_text(), media_type="text/plain; version=0.0.4"
+    )
+
+
+if TRACER.prometheus:
+    # Chainlit serves its frontend from a catch-all route, so this must go first
+    app.router.routes.insert(0, Route("/metrics", metrics, methods=["GET"]))
+
+
+async def admin_invalidate_index(request: Request) -> PlainTextResponse:
+    """Drop the cached answers, searches and previews after the index is rebuilt."""
+    expected = f"Bearer {os.environ['Admin__Token']}"
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), expected):
+        return PlainTextResponse("Unauthorized", status_code=401)
+
+    invalidate_index()
+    return PlainTextResponse("Invalidated")
+
+
+if os.environ.get("Admin__Token"):
+    app.router.routes.insert(
+        0, Route("/admin/invalidate-index", admin_invalidate_index, methods=["POST"])
+    )
 
 
 @cl.on_chat_start  # type: ignore
@@ -67,12 +86,80 @@ async def start_chat() -> None:
 
     cl.user_session.set("agent", settings["Agent"])  # Store selection in session state
 
+    team_manager = TeamManager(cl.context.session.id)
+    team_manager.select(settings["Agent"])
+    cl.user_session.set("team_manager", team_manager)
+
+    # Fetch the searches the first question is likely to make while the user types
+    PREWARMER.start(
+        team_manager.get(settings["Agent"]).search_tool,
+        STARTER_QUESTIONS,
+        settings["Agent"],
+    )
+
+
+@cl.on_chat_end
+async def end_chat() -> None:
+    """Cancel the session's background searches and drop its stored state."""
+    team_manager = cl.user_session.get("team_manager")  # type: ignore
+
+    if team_manager is not None:
+        for team in team_manager.teams.values():
+            team.search_tool.cancel_prewarm()
+
+        team_manager.close()
+
+
+warm_task: asyncio.Task | None = None
+version_task: asyncio.Task | None = None
+
+
+@cl.on_app_startup
+async def startup() -> None:
+    """Answer the starter questions in the background so they replay instantly."""
+    global warm_task, version_task
+
+    if ANSWER_CACHE.enabled:
+        version_task = asyncio.create_task(INDEX_VERSION.watch())
+
+    if os.environ.get("AnswerCache__WarmOnStartup", "false").lower() == "true":
+        warm_task = asyncio.create_task(ANSWER_CACHE.warm(STARTER_QUESTIONS))
+
+
+@cl.on_app_shutdown
+async def shutdown() -> None:
+    """Close the pooled search clients when the app stops."""
+    for task in (warm_task, version_task):
+        if task is not None:
+            task.cancel()
+
+    await SEARCH_CLIENT_POOL.close()
+    TRACER.close()
+    SESSION_STATE.close()
+
+
+@cl.on_stop
+async def stop_chat() -> None:
+    """Cancel the team's in-flight work when the user stops the turn."""
+    cancellation_token = cl.user_session.get("cancellation_token")  # type: ignore
+
+    if cancellation_token is not None:
+        cancellation_token.cancel()
+
 
 @cl.on_settings_update
 async def handle_agent_update(settings: dict):
     """Handle the agent update in settings."""
     cl.user_session.set("agent", settings["Agent"])  # Store selection in session state
 
+    team_manager = cl.user_session.get("team_manager")
+    team_manager.select(settings["Agent"])
+    PREWARMER.start(
+        team_manager.get(settings["Agent"]).search_tool,
+        STARTER_QUESTIONS,
+        settings["Agent"],
+    )
+
 
 @cl.set_starters  # type: ignore
 async def set_starts() -> List[cl.Starter]:
@@ -81,26 +168,7 @@ async def set_starts() -> List[cl.Starter]:
     Returns:
         List[cl.Starter]: List of starters."""
     return [
-        cl.Starter(
-            label="What is the approach for sustainability?",
-            message="What is the approach for sustainability?",
-        ),
-        cl.Starter(
-            label="What priority areas will have the most impact on the business and it's stakeholders?",
-            message="What priority areas will have the most impact on the business and it's stakeholders?",
-        ),
-        cl.Starter(
-            label="How is Shein innovating?",
-            message="How is Shein innovating?",
-        ),
-        cl.Starter(
-            label="How does Shein enforce compliance throughput the supply chain?",
-            message="How does Shein enforce compliance throughput the supply chain?",
-        ),
-        cl.Starter(
-            label="What is Shein doing to be more sustainable?",
-            message="What is Shein doing to be more sustainable?",
-        ),
+        cl.Starter(label=question, message=question) for question in STARTER_QUESTIONS
     ]
 
 
@@ -112,24 +180,76 @@ async def chat(message: cl.Message) -> None:
         message (cl.Message): Message to handle."""
     # Get the team from the user session.
     agent = cl.user_session.get("agent")  # type: ignore
+    team_manager = cl.user_session.get("team_manager")  # type: ignore
+
+    key = ANSWER_CACHE.make_key(message.content, agent)
+    answer = ANSWER_CACHE.get(key)
 
-    if agent == "RAG Agent":
-        team = Rag()
-    elif agent == "RAT Agent":
-        team = Rat()
-    else:
+    team = await team_manager.team_for_turn(agent)
+    if team is None:
         return
 
+    if answer is not None:
+        # Replay the cached turn through the same rendering as a live one
+        with TRACER.span("answer_cache.replay", agent=agent):
+            await render(
+                answer.replay(team.figure_and_chunk_pairs, ANSWER_CACHE.token_delay),
+                agent,
+                answer.search_results,
+                team.figure_and_chunk_pairs,
+            )
+        return
+
+    # Kept so a stop from the UI can cancel the team's in-flight model calls
+    cancellation_token = CancellationToken()
+    cl.user_session.set("cancellation_token", cancellation_token)
+
+    recorder = AnswerRecorder(team.search_results, team.figure_and_chunk_pairs)
+    stream = team.run_stream(
+        task=[TextMessage(content=message.content, source="user")],
+        cancellation_token=cancellation_token,
+    )
+
+    try:
+        await render(
+            recorder.record(stream),
+            agent,
+            team.search_results,
+            team.figure_and_chunk_pairs,
+        )
+    except BaseException:
+        cancellation_token.cancel()
+        raise
+    finally:
+        # Shut the group chat's run down so the next turn can reset the team
+        await stream.aclose()
+        cl.user_session.set("cancellation_token", None)
+
+    ANSWER_CACHE.set(key, recorder.answer())
+    SEARCH_HISTORY.record(message.content, agent, team.search_tool.searches)
+
+
+async def render(
+    stream: AsyncIterator,
+    agent: str,
+    search_results: SearchResultRegistry,
+    figure_store: FigureStore,
+) -> None:
+    """Render a turn's message stream, live or replayed from the answer cache.
+
+    Args:
+        stream (AsyncIterator): The team's messages.
+        agent (str): The agent choice the turn was answered with.
+        search_results (SearchResultRegistry): Registry to resolve retrievals from.
+        figure_store (FigureStore): Store to resolve figures from."""
     # Streaming response message.
     streaming_response: cl.Message | None = None
+    streamer: CoalescingStreamer | None = None
+    figure_parser: FigureTagParser | None = None
+    stream_started = 0.0
     # Stream the messages from the team.
-    # Rest the team
-    last_chunk_is_image = False
 
-    async for msg in team.group_chat.run_stream(
-        task=[TextMessage(content=message.content, source="user")],
-        cancellation_token=CancellationToken(),
-    ):
+    async for msg in stream:
         if isinstance(msg, ToolCallRequestEvent):
             # Handle the tool call request.
             search_terms = msg.content[0].arguments
@@ -145,35 +265,42 @@ async def chat(message: cl.Message) -> None:
                     extracted_search_terms = ", ".join(args["search_terms"])
 
                 if extracted_search_terms is not None:
-                    await cl.Message(
-                        content=f"**Research Agent ({agent}):**\n\nSearching AI Search with: *'{extracted_search_terms}'*"
-                    ).send()
+                    with TRACER.span("ui.send", kind="search_terms"):
+                        await cl.Message(
+                            content=f"**Research Agent ({agent}):**\n\nSearching AI Search with: *'{extracted_search_terms}'*"
+                        ).send()
             except json.JSONDecodeError:
                 pass
         elif isinstance(msg, ToolCallExecutionEvent):
             # Handle the tool call execution.
             ai_search_results = msg.content[0].content
             try:
-                results = json.loads(ai_search_results)
+                results = await search_results.load(ai_search_results)
+                for chunk_id in results:
+                    await figure_store.load_chunk(chunk_id)
 
                 retrieval_message = f"**Research Agent ({agent}):**\n\nRetrieved the following information:"
                 image_retrievals = []
                 for chunk_id, result in results.items():
-                    cleaned_text, chunk_image_retrievals = get_figures_from_chunk(
-                        team.figure_and_chunk_pairs, result["Chunk"], chunk_id=chunk_id
+                    _, chunk_image_retrievals = await get_figures_from_chunk(
+                        figure_store, result.chunk, chunk_id=chunk_id
                     )
 
                     image_retrievals.extend(chunk_image_retrievals)
 
-                    first_150_chars = cleaned_text[:150]
-
                     retrieval_message += (
-                        f"\n\n {remove_markdown_formatting(first_150_chars)}... "
+                        f"\n\n {chunk_preview(chunk_id, result.chunk)}... "
                     )
 
-                await cl.Message(
-                    content=retrieval_message, elements=image_retrievals
-                ).send()
+                with TRACER.span(
+                    "ui.send",
+                    kind="retrieval",
+                    chunks=len(results),
+                    figures=len(image_retrievals),
+                ):
+                    await cl.Message(
+                        content=retrieval_message, elements=image_retrievals
+                    ).send()
             except json.JSONDecodeError:
                 pass
         elif isinstance(msg, ModelClientStreamingChunkEvent):
@@ -184,23 +311,31 @@ async def chat(message: cl.Message) -> None:
                 if streaming_response is None:
                     # Start a new streaming response.
                     streaming_response = cl.Message(content="", author=msg.source)
+                    streamer = CoalescingStreamer(streaming_response)
+                    figure_parser = FigureTagParser()
+                    stream_started = time.perf_counter()
 
                     # Stream the printable author
                     printable_author = (
                         "**" + author.replace("_", " ").title() + f" ({agent}):**\n\n"
                     )
-                    await streaming_response.stream_token(printable_author)
-
-                    await streaming_response.stream_token(msg.content)
-
-                else:
-                    if "<" in msg.content:
-                        last_chunk_is_image = True
-                        # Split content up to <figure
-                        content_split = msg.content.split("<")[0]
-                        await streaming_response.stream_token(content_split)
-                    elif last_chunk_is_image is False:
-                        await streaming_response.stream_token(msg.content)
+                    await streamer.stream_token(printable_author)
+
+                for segment in figure_parser.feed(msg.content):
+                    if isinstance(segment, FigureTag):
+                        # Push the figure as soon as its tag closes
+                        image = await get_figure(
+                            figure_store,
+                            segment.chunk_id,
+                            segment.figure_id,
+                        )
+                        if image is not None:
+                            # The text before the figure goes out first
+                            await streamer.flush()
+                            with TRACER.span("ui.send", kind="figure"):
+                                await image.send(for_id=streaming_response.id)
+                    else:
+                        await streamer.stream_token(segment)
         elif (
             streaming_response is not None and isinstance(msg, TextMessage)
         ) or isinstance(msg, TextMessage):
@@ -211,23 +346,37 @@ async def chat(message: cl.Message) -> None:
                     "**" + author.replace("_", " ").title() + f" ({agent}):**\n\n"
                 )
 
-                clean_text, image_retrievals = get_figures_from_chunk(
-                    team.figure_and_chunk_pairs, msg.content
-                )
-                cleaned_content = printable_author + clean_text
-
                 if streaming_response is not None:
-                    last_chunk_is_image = False
-                    streaming_response.content = cleaned_content
+                    await streamer.close()
+
+                    # The figures were pushed as their tags streamed in
+                    streaming_response.content = printable_author + strip_figure_tags(
+                        msg.content
+                    )
+
+                    TRACER.record(
+                        "ui.stream",
+                        time.perf_counter() - stream_started,
+                        agent=author,
+                        tokens=streamer.tokens,
+                        frames=streamer.frames,
+                    )
 
-                    await streaming_response.send()
+                    with TRACER.span("ui.send", kind="answer"):
+                        await streaming_response.send()
                     streaming_response = None
-                    if len(image_retrievals) > 0:
-                        await cl.Message(content="", elements=image_retrievals).send()
                 else:
-                    await cl.Message(
-                        content=cleaned_content, elements=image_retrievals
-                    ).send()
+                    clean_text, image_retrievals = await get_figures_from_chunk(
+                        figure_store, msg.content
+                    )
+
+                    with TRACER.span(
+                        "ui.send", kind="answer", figures=len(image_retrievals)
+                    ):
+                        await cl.Message(
+                            content=printable_author + clean_text,
+                            elements=image_retrievals,
+                        ).send()
 
         else:
             # Skip all other message types.
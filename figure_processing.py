@@ -1,9 +1,46 @@
 import chainlit as cl
+from figure_store import FigureStore
 import re
 
+# Figure placeholders the answer agents add to their responses
+FIGURE_TAG_PATTERN = re.compile(r"<figure\s+ChunkId='(.*?)'\s+FigureId='(.*?)'>")
+ANY_FIGURE_TAG_PATTERN = re.compile(r"<figure\s+[^>]*>")
 
-def get_figures_from_chunk(
-    chunk_and_figure_pairs: dict,
+
+def strip_figure_tags(text: str) -> str:
+    """Remove all figure placeholders from the text."""
+    return ANY_FIGURE_TAG_PATTERN.sub("", text)
+
+
+async def get_figure(
+    chunk_and_figure_pairs: FigureStore, chunk_id: str, figure_id: str
+) -> cl.Image | None:
+    """Load a single figure as a Chainlit image, decoding it off the event loop.
+
+    Args:
+        chunk_id (str): Chunk ID the figure belongs to.
+        figure_id (str): Figure ID within the chunk.
+
+    Returns:
+        cl.Image | None: The image, or None if the figure has not been retrieved.
+    """
+    if (
+        chunk_id not in chunk_and_figure_pairs
+        or figure_id not in chunk_and_figure_pairs[chunk_id]
+    ):
+        return None
+
+    figure = chunk_and_figure_pairs[chunk_id][figure_id]
+
+    return cl.Image(
+        content=await chunk_and_figure_pairs.decode(figure.digest),
+        name=f"Figure {figure_id}",
+        display="inline",
+    )
+
+
+async def get_figures_from_chunk(
+    chunk_and_figure_pairs: FigureStore,
     text: str,
     chunk_id: str = None,
     cast_to_chainlit_image: bool = True,
@@ -13,17 +50,15 @@ def get_figures_from_chunk(
     Args:
         text (str): Text to extract figures from.
         chunk_id (str, optional): Chunk ID to extract figures for. Defaults to None.
+        cast_to_chainlit_image (bool, optional): Return Chainlit images rather than the StoredFigure handles. Defaults to True.
 
     Returns:
         tuple[str, list[cl.Image]]: Tuple containing the cleaned text and a list of images.
     """
 
     if chunk_id is None:
-        # Regex pattern to extract figure chunk_id and figure_id
-        pattern = r"<figure\s+ChunkId='(.*?)'\s+FigureId='(.*?)'>"
-
         # Find all matches and convert to dictionary
-        figure_dict = {match[1]: match[0] for match in re.findall(pattern, text)}
+        figure_dict = {match[1]: match[0] for match in FIGURE_TAG_PATTERN.findall(text)}
     else:
         figure_ids = re.findall(r"FigureId='(.*?)'", text)
 
@@ -37,18 +72,12 @@ def get_figures_from_chunk(
             chunk_id in chunk_and_figure_pairs
             and figure_id in chunk_and_figure_pairs[chunk_id]
         ):
-            image_data = chunk_and_figure_pairs[chunk_id][figure_id]
-
             if cast_to_chainlit_image:
-                image = cl.Image(
-                    content=image_data,
-                    name=f"Figure {figure_id}",
-                    display="inline",
-                )
+                image = await get_figure(chunk_and_figure_pairs, chunk_id, figure_id)
             else:
-                image = image_data
+                image = chunk_and_figure_pairs[chunk_id][figure_id]
             image_retrievals.append(image)
 
-    cleaned_text = re.sub(r"<figure\s+[^>]*>", "", text)
+    cleaned_text = strip_figure_tags(text)
 
     return cleaned_text, image_retrievals
@@ -0,0 +1,439 @@
+from autogen_core import Image
+from collections import OrderedDict
+from io import BytesIO
+import PIL.Image
+import asyncio
+import base64
+import hashlib
+import mmap
+import os
+import tempfile
+import time
+import weakref
+from session_state import SESSION_STATE, SessionState
+from settings import load_environment
+from tracing import TRACER
+
+
+class StoredFigure:
+    """Handle to a figure payload held in the FigureStore."""
+
+    # The store drops a payload once no handle to it is left
+    __slots__ = ("store", "digest", "__weakref__")
+
+    def __init__(self, store: "FigureStore", digest: str):
+        self.store = store
+        self.digest = digest
+
+    @property
+    def encoded(self) -> bytes | memoryview:
+        """The base64 payload, read from memory or straight off the spill file."""
+        return self.store.get_encoded(self.digest)
+
+    @property
+    def decoded(self) -> bytes:
+        """The raw image bytes, memoised within the store's memory budget."""
+        return self.store.get_decoded(self.digest)
+
+    @property
+    def image(self) -> Image:
+        """The figure as an AutoGen image for multimodal messages, memoised."""
+        return self.store.get_image(self.digest)
+
+
+class FigureStore:
+    """Process-wide, content addressed store for figure payloads.
+
+    Payloads are de-duplicated by hash, so a figure retrieved by many sessions is
+    held once. Memory use is capped by an LRU byte budget; payloads evicted from
+    memory are appended to a memory-mapped segment file and read back as views
+    over the map rather than copies.
+
+    The store also keeps the chunk to figure index and exposes the same lookup
+    API as the plain dict it replaces: `chunk_id in store` and
+    `store[chunk_id][figure_id]`. The index is an LRU capped at `max_chunks`.
+
+    A payload is kept while a StoredFigure handle to it is alive, in the chunk
+    index, the search cache or a cached answer. Once the last handle goes the
+    payload is released, and the segment is rewritten without released payloads
+    when they outweigh the live ones.
+
+    With a shared session state backend, payloads and the chunk index are
+    written through to it, and `load_chunk` reads chunks missing here from it,
+    so any worker can serve a figure another retrieved. The lookups themselves
+    never wait on the backend."""
+
+    def __init__(
+        self,
+        max_memory_bytes: int = None,
+        spill_directory: str = None,
+        backend: SessionState | None = None,
+        max_chunks: int = None,
+        max_images: int = None,
+        compact_bytes: int = None,
+    ):
+        if max_memory_bytes is None:
+            max_memory_bytes = int(
+                os.environ.get("FigureStore__MaxMemoryBytes", 128 * 1024 * 1024)
+            )
+        if spill_directory is None:
+            spill_directory = os.environ.get("FigureStore__SpillDirectory")
+        if max_chunks is None:
+            max_chunks = int(os.environ.get("FigureStore__MaxChunks", 4096))
+        if max_images is None:
+            max_images = int(os.environ.get("FigureStore__MaxImages", 64))
+        if compact_bytes is None:
+            compact_bytes = int(
+                os.environ.get("FigureStore__CompactBytes", 64 * 1024 * 1024)
+            )
+
+        self.max_memory_bytes = max_memory_bytes
+        self.spill_directory = spill_directory
+        self.backend = backend
+        self.max_chunks = max_chunks
+        self.max_images = max_images
+        self.compact_bytes = compact_bytes
+
+        self.chunk_figures: OrderedDict[str, dict[str, StoredFigure]] = OrderedDict()
+
+        # digest -> weak reference to the handle for the payload
+        self._handles: dict[str, weakref.ref] = {}
+
+        # digest -> base64 payload for payloads held in memory
+        self._encoded: OrderedDict[str, bytes] = OrderedDict()
+        # digest -> decoded bytes, dropped rather than spilled when evicted
+        self._decoded: OrderedDict[str, bytes] = OrderedDict()
+        # digest -> (offset, length) in the segment file
+        self._spilled: dict[str, tuple[int, int]] = {}
+        # digest -> decode running on a worker thread
+        self._decoding: dict[str, asyncio.Future] = {}
+        # digest -> image opened for multimodal messages
+        self._images: OrderedDict[str, Image] = OrderedDict()
+
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+        # Bytes of the segment file taken by released payloads
+        self.released_bytes = 0
+        self.deduplicated = 0
+        self.decodes = 0
+        self.decode_seconds = 0.0
+
+        self._segment = None
+        self._map = None
+        # Maps replaced while callers still held views over them
+        self._retired_maps: list[mmap.mmap] = []
+
+    async def load_chunk(self, chunk_id: str) -> dict[str, StoredFigure] | None:
+        """Get the figures of a chunk, reading them from the backend on a miss."""
+        figures = self.chunk_figures.get(chunk_id)
+        if figures is not None or self.backend is None:
+            return figures
+
+        digests = await self.backend.get_chunk_figures(chunk_id)
+        if digests is None:
+            return None
+
+        handles = {}
+        for digest in set(digests.values()):
+            handles[digest] = self.handle(digest)
+            if handles[digest] is not None:
+                continue
+
+            payload = await self.backend.get_figure(digest)
+            if payload is None:
+                # Pruned from the backend, so the chunk cannot be served
+                return None
+
+            handles[digest] = self.add_payload(digest, payload)
+
+        # Another load may have finished while this one waited on the backend
+        return self.setdefault(
+            chunk_id,
+            {figure_id: handles[digest] for figure_id, digest in digests.items()},
+        )
+
+    def __contains__(self, chunk_id: str) -> bool:
+        return chunk_id in self.chunk_figures
+
+    def __getitem__(self, chunk_id: str) -> dict[str, StoredFigure]:
+        figures = self.chunk_figures[chunk_id]
+        self.chunk_figures.move_to_end(chunk_id)
+        return figures
+
+    def get(self, chunk_id: str, default=None) -> dict[str, StoredFigure] | None:
+        figures = self.chunk_figures.get(chunk_id)
+        if figures is None:
+            return default
+
+        self.chunk_figures.move_to_end(chunk_id)
+        return figures
+
+    def setdefault(
+        self, chunk_id: str, default: dict[str, StoredFigure]
+    ) -> dict[str, StoredFigure]:
+        figures = self.chunk_figures.setdefault(chunk_id, default)
+        self.chunk_figures.move_to_end(chunk_id)
+
+        while len(self.chunk_figures) > self.max_chunks:
+            self.chunk_figures.popitem(last=False)
+
+        return figures
+
+    def add_figures(self, chunk_id: str, figures: dict[str, StoredFigure]) -> None:
+        """Index the figures of a chunk by FigureId.
+
+        Args:
+            chunk_id (str): The chunk the figures belong to.
+            figures (dict[str, StoredFigure]): Handles to the figures by FigureId."""
+        self.setdefault(chunk_id, {}).update(figures)
+
+        if self.backend is not None:
+            self.backend.put_chunk_figures(
+                chunk_id,
+                {figure_id: figure.digest for figure_id, figure in figures.items()},
+            )
+
+    def put(self, encoded: str) -> StoredFigure:
+        """Store a base64 payload and return a handle to it.
+
+        Args:
+            encoded (str): The base64 encoded figure.
+
+        Returns:
+            StoredFigure: Handle to the stored figure."""
+        payload = encoded.encode("ascii")
+        digest = hashlib.sha256(payload).hexdigest()
+
+        figure = self.handle(digest)
+        if figure is not None:
+            self.deduplicated += 1
+            return figure
+
+        if self.backend is not None:
+            self.backend.put_figure(digest, payload)
+
+        return self.add_payload(digest, payload)
+
+    def handle(self, digest: str) -> StoredFigure | None:
+        """The live handle to a stored payload, or None if it was released."""
+        reference = self._handles.get(digest)
+        return reference() if reference is not None else None
+
+    def add_payload(self, digest: str, payload: bytes) -> StoredFigure:
+        """Hold a payload in memory and return the handle that keeps it."""
+        figure = StoredFigure(self, digest)
+        self._handles[digest] = weakref.ref(
+            figure, lambda _, digest=digest: self.release(digest)
+        )
+
+        self._encoded[digest] = payload
+        self.memory_bytes += len(payload)
+        self.evict()
+
+        return figure
+
+    def release(self, digest: str) -> None:
+        """Drop a payload once its last handle is gone."""
+        if self.handle(digest) is not None:
+            return
+
+        self._handles.pop(digest, None)
+        self._images.pop(digest, None)
+
+        payload = self._encoded.pop(digest, None)
+        if payload is not None:
+            self.memory_bytes -= len(payload)
+
+        decoded = self._decoded.pop(digest, None)
+        if decoded is not None:
+            self.memory_bytes -= len(decoded)
+
+        location = self._spilled.pop(digest, None)
+        if location is not None:
+            self.spilled_bytes -= location[1]
+            self.released_bytes += location[1]
+
+    def get_encoded(self, digest: str) -> bytes | memoryview:
+        if digest in self._encoded:
+            self._encoded.move_to_end(digest)
+            return self._encoded[digest]
+
+        offset, length = self._spilled[digest]
+        if self._map is None or offset + length > len(self._map):
+            # The segment has grown since it was mapped
+            self._segment.flush()
+            self.retire_map()
+            self._map = mmap.mmap(self._segment.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return memoryview(self._map)[offset : offset + length]
+
+    def get_decoded(self, digest: str) -> bytes:
+        if digest in self._decoded:
+            self._decoded.move_to_end(digest)
+            return self._decoded[digest]
+
+        with TRACER.span("figure.decode") as span:
+            started = time.perf_counter()
+            decoded = base64.b64decode(self.get_encoded(digest))
+            self.decode_seconds += time.perf_counter() - started
+            self.decodes += 1
+
+            span.set(bytes=len(decoded))
+
+        self.keep_decoded(digest, decoded)
+
+        return decoded
+
+    async def decode(self, digest: str) -> bytes:
+        """Decode a payload on a worker thread, memoising it as `get_decoded` does.
+
+        Used to decode figures ahead of time without holding up the event loop.
+        Concurrent calls for a payload share one decode."""
+        if digest in self._decoded:
+            return self.get_decoded(digest)
+
+        decoding = self._decoding.get(digest)
+        if decoding is None:
+            decoding = self._decoding[digest] = asyncio.ensure_future(
+                self.decode_in_thread(digest)
+            )
+            decoding.add_done_callback(
+                lambda _, digest=digest: self._decoding.pop(digest, None)
+            )
+
+        # A cancelled caller leaves the decode running for the others
+        return await asyncio.shield(decoding)
+
+    async def decode_in_thread(self, digest: str) -> bytes:
+        with TRACER.span("figure.decode") as span:
+            started = time.perf_counter()
+            decoded = await asyncio.to_thread(
+                base64.b64decode, self.get_encoded(digest)
+            )
+            self.decode_seconds += time.perf_counter() - started
+            self.decodes += 1
+
+            span.set(bytes=len(decoded))
+
+        # The payload may have been released or decoded inline meanwhile
+        if self.handle(digest) is not None and digest not in self._decoded:
+            self.keep_decoded(digest, decoded)
+
+        return decoded
+
+    def keep_decoded(self, digest: str, decoded: bytes) -> None:
+        self._decoded[digest] = decoded
+        self.memory_bytes += len(decoded)
+        self.evict()
+
+    def get_image(self, digest: str) -> Image:
+        if digest in self._images:
+            self._images.move_to_end(digest)
+            return self._images[digest]
+
+        image = self._images[digest] = Image(
+            PIL.Image.open(BytesIO(self.get_decoded(digest)))
+        )
+        while len(self._images) > self.max_images:
+            self._images.popitem(last=False)
+
+        return image
+
+    def spill(self, digest: str, payload: bytes) -> None:
+        """Append a payload to the segment file."""
+        if self._segment is None:
+            self._segment = tempfile.TemporaryFile(
+                prefix="figures-", suffix=".seg", dir=self.spill_directory
+            )
+
+        elif (
+            self.released_bytes > self.compact_bytes
+            and self.released_bytes > self.spilled_bytes
+        ):
+            self.compact()
+
+        offset = self._segment.seek(0, os.SEEK_END)
+        self._segment.write(payload)
+        self._spilled[digest] = (offset, len(payload))
+        self.spilled_bytes += len(payload)
+
+    def compact(self) -> None:
+        """Rewrite the segment file with only the payloads still spilled."""
+        segment = tempfile.TemporaryFile(
+            prefix="figures-", suffix=".seg", dir=self.spill_directory
+        )
+
+        spilled = {}
+        for digest, (offset, length) in list(self._spilled.items()):
+            self._segment.seek(offset)
+            spilled[digest] = (segment.tell(), length)
+            segment.write(self._segment.read(length))
+
+        self.retire_map()
+        self._segment.close()
+
+        self._segment = segment
+        # Skip any payload released while the segment was being rewritten
+        self._spilled = {
+            digest: location
+            for digest, location in spilled.items()
+            if digest in self._spilled
+        }
+        self.released_bytes = 0
+
+    def retire_map(self) -> None:
+        """Close the current map and any earlier ones no longer viewed."""
+        if self._map is not None:
+            self._retired_maps.append(self._map)
+            self._map = None
+
+        retired = []
+        for segment_map in self._retired_maps:
+            try:
+                segment_map.close()
+            except BufferError:
+                # A caller still holds a view over it, try again next time
+                retired.append(segment_map)
+
+        self._retired_maps = retired
+
+    def evict(self) -> None:
+        """Evict least recently used payloads until the memory budget is met."""
+        while self.memory_bytes > self.max_memory_bytes:
+            # Decoded copies can be rebuilt, so they go first
+            if self._decoded:
+                _, decoded = self._decoded.popitem(last=False)
+                self.memory_bytes -= len(decoded)
+            elif self._encoded:
+                digest, payload = self._encoded.popitem(last=False)
+                self.memory_bytes -= len(payload)
+                self.spill(digest, payload)
+            else:
+                break
+
+    def drop_decoded(self) -> None:
+        """Release every decoded copy, keeping the encoded payloads."""
+        self._images.clear()
+
+        while self._decoded:
+            _, decoded = self._decoded.popitem()
+            self.memory_bytes -= len(decoded)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "chunks": len(self.chunk_figures),
+            "figures": len(self._encoded) + len(self._spilled),
+            "memory_bytes": self.memory_bytes,
+            "spilled_bytes": self.spilled_bytes,
+            "released_bytes": self.released_bytes,
+            "deduplicated": self.deduplicated,
+            "decodes": self.decodes,
+            "decode_seconds": self.decode_seconds,
+        }
+
+
+load_environment()
+# The process store already holds figures in memory, so only a shared backend is
+# worth writing them through to
+FIGURE_STORE = FigureStore(backend=SESSION_STATE if SESSION_STATE.shared else None)
@@ -0,0 +1,87 @@
+from typing import NamedTuple
+from figure_processing import ANY_FIGURE_TAG_PATTERN, FIGURE_TAG_PATTERN
+
+FIGURE_TAG_START = "<figure"
+
+
+class FigureTag(NamedTuple):
+    chunk_id: str
+    figure_id: str
+
+
+class FigureTagParser:
+    """Incremental parser that splits a streamed answer into text and figure tags.
+
+    Plain text is passed straight through. Text from a "<" onwards is only held
+    back while it could still be the start of a figure tag, so a comparison such
+    as "a < b" is released as soon as the next token rules out a tag."""
+
+    def __init__(self, max_tag_length: int = 512):
+        self.max_tag_length = max_tag_length
+        self._buffer = ""
+
+    def feed(self, token: str) -> list[str | FigureTag]:
+        """Feed the next streamed token.
+
+        Args:
+            token (str): The streamed token.
+
+        Returns:
+            list[str | FigureTag]: Text ready to stream and any figure tags that closed.
+        """
+        self._buffer += token
+        segments = []
+
+        while self._buffer:
+            start = self._buffer.find("<")
+
+            if start == -1:
+                segments.append(self._buffer)
+                self._buffer = ""
+                break
+
+            if start > 0:
+                segments.append(self._buffer[:start])
+                self._buffer = self._buffer[start:]
+
+            end = self._buffer.find(">")
+
+            if end == -1:
+                if len(self._buffer) <= len(FIGURE_TAG_START):
+                    could_be_tag = FIGURE_TAG_START.startswith(self._buffer)
+                else:
+                    could_be_tag = (
+                        self._buffer.startswith(FIGURE_TAG_START)
+                        and self._buffer[len(FIGURE_TAG_START)].isspace()
+                        and len(self._buffer) < self.max_tag_length
+                    )
+
+                if could_be_tag:
+                    # Wait for the rest of the tag
+                    break
+
+                segments.append("<")
+                self._buffer = self._buffer[1:]
+                continue
+
+            tag = self._buffer[: end + 1]
+            match = FIGURE_TAG_PATTERN.fullmatch(tag)
+
+            if match is not None:
+                segments.append(FigureTag(match[1], match[2]))
+                self._buffer = self._buffer[end + 1 :]
+            elif ANY_FIGURE_TAG_PATTERN.fullmatch(tag) is not None:
+                # Malformed figure tags are dropped, as they are from the final text
+                self._buffer = self._buffer[end + 1 :]
+            else:
+                segments.append("<")
+                self._buffer = self._buffer[1:]
+
+        return [segment for segment in segments if segment != ""]
+
+    def flush(self) -> str:
+        """Release any text still held back at the end of the stream."""
+        remaining = self._buffer
+        self._buffer = ""
+
+        return remaining
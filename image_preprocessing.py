@@ -0,0 +1,229 @@
+from autogen_core import Image
+from collections import OrderedDict
+from figure_store import StoredFigure
+from settings import load_environment
+from tracing import TRACER
+from io import BytesIO
+from typing import NamedTuple
+import PIL.Image
+import asyncio
+import base64
+import hashlib
+import math
+import numpy as np
+import os
+import time
+
+# OpenAI bills high detail images in 512px tiles
+TILE_SIZE = 512
+
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+
+class CompactImage(Image):
+    """An AutoGen image that keeps its compact encoding.
+
+    AutoGen re-encodes images as PNG every time they are serialized, so the
+    normalised encoding is kept and handed out as is."""
+
+    def __init__(self, image: PIL.Image.Image, encoded: str, mime_type: str):
+        super().__init__(image)
+        self.encoded = encoded
+        self.mime_type = mime_type
+
+    def to_base64(self) -> str:
+        return self.encoded
+
+    @property
+    def data_uri(self) -> str:
+        return f"data:{self.mime_type};base64,{self.encoded}"
+
+
+class NormalisedFigure(NamedTuple):
+    image: CompactImage
+    digest: str
+    perceptual_hash: int
+
+
+def difference_hash(image: PIL.Image.Image, hash_size: int = 8) -> int:
+    """Compute the 64 bit difference hash used to spot near-duplicate figures."""
+    pixels = np.asarray(
+        image.convert("L").resize((hash_size + 1, hash_size), PIL.Image.BILINEAR),
+        dtype=np.int16,
+    )
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+class FigureSelection:
+    """Selects the figures attached in one turn, dropping duplicates and capping the count."""
+
+    def __init__(self, preprocessor: "FigurePreprocessor"):
+        self.preprocessor = preprocessor
+        self.digests = set()
+        self.perceptual_hashes = []
+        self.dropped = 0
+
+    async def candidate(self, figure: StoredFigure) -> NormalisedFigure | None:
+        """Normalise a figure, or return None if it should not be attached.
+
+        The figure is not counted against the cap or the duplicates until it is
+        added, so the caller can still drop it, e.g. for the token budget."""
+        if len(self.digests) >= self.preprocessor.max_images:
+            self.dropped += 1
+            return None
+
+        normalised = await self.preprocessor.normalise(figure)
+
+        is_duplicate = normalised.digest in self.digests or any(
+            (normalised.perceptual_hash ^ perceptual_hash).bit_count()
+            <= self.preprocessor.hash_distance
+            for perceptual_hash in self.perceptual_hashes
+        )
+        if is_duplicate:
+            self.dropped += 1
+            return None
+
+        return normalised
+
+    def add(self, normalised: NormalisedFigure) -> CompactImage:
+        """Attach a figure returned by `candidate`."""
+        self.digests.add(normalised.digest)
+        self.perceptual_hashes.append(normalised.perceptual_hash)
+
+        return normalised.image
+
+
+class FigurePreprocessor:
+    """Downscales and re-encodes figures before they are sent to the vision model.
+
+    Normalised figures are cached by the content hash of the stored payload. The
+    decode, resize and re-encode run on a worker thread so they do not hold up
+    the other sessions on the event loop."""
+
+    def __init__(
+        self,
+        max_side: int = None,
+        max_tiles: int = None,
+        image_format: str = None,
+        quality: int = None,
+        max_images: int = None,
+        hash_distance: int = None,
+        cache_size: int = 512,
+    ):
+        if max_side is None:
+            max_side = int(os.environ.get("FigurePreprocessing__MaxSide", 1024))
+        if max_tiles is None:
+            max_tiles = int(os.environ.get("FigurePreprocessing__MaxTiles", 4))
+        if image_format is None:
+            image_format = os.environ.get("FigurePreprocessing__Format", "JPEG")
+        if quality is None:
+            quality = int(os.environ.get("FigurePreprocessing__Quality", 85))
+        if max_images is None:
+            max_images = int(os.environ.get("FigurePreprocessing__MaxImagesPerTurn", 8))
+        if hash_distance is None:
+            hash_distance = int(
+                os.environ.get("FigurePreprocessing__PerceptualHashDistance", 4)
+            )
+
+        self.max_side = max_side
+        self.max_tiles = max_tiles
+        self.image_format = image_format.upper()
+        self.quality = quality
+        self.max_images = max_images
+        self.hash_distance = hash_distance
+        self.cache_size = cache_size
+
+        self._cache: OrderedDict[str, NormalisedFigure] = OrderedDict()
+        # In-flight normalisations by payload digest
+        self._normalising: dict[str, asyncio.Future] = {}
+        self.normalised = 0
+        self.normalise_seconds = 0.0
+
+    def target_size(self, width: int, height: int) -> tuple[int, int]:
+        """Fit the size within the longest side limit and the tile budget."""
+        scale = min(1.0, self.max_side / max(width, height))
+
+        while scale > 0.05:
+            tiles = math.ceil(width * scale / TILE_SIZE) * math.ceil(
+                height * scale / TILE_SIZE
+            )
+            if tiles <= self.max_tiles:
+                break
+            scale *= 0.9
+
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    async def normalise(self, figure: StoredFigure) -> NormalisedFigure:
+        """Downscale and re-encode a figure, using the cache where possible.
+
+        Concurrent calls for a figure share one normalisation."""
+        if figure.digest in self._cache:
+            self._cache.move_to_end(figure.digest)
+            return self._cache[figure.digest]
+
+        normalising = self._normalising.get(figure.digest)
+        if normalising is None:
+            normalising = self._normalising[figure.digest] = asyncio.ensure_future(
+                self.normalise_in_thread(figure)
+            )
+            normalising.add_done_callback(
+                lambda _, digest=figure.digest: self._normalising.pop(digest, None)
+            )
+
+        # A cancelled caller leaves the normalisation running for the others
+        return await asyncio.shield(normalising)
+
+    async def normalise_in_thread(self, figure: StoredFigure) -> NormalisedFigure:
+        decoded = await figure.store.decode(figure.digest)
+
+        started = time.perf_counter()
+        normalised = await asyncio.to_thread(self.normalise_payload, decoded)
+
+        elapsed = time.perf_counter() - started
+        self.normalise_seconds += elapsed
+        self.normalised += 1
+        TRACER.record(
+            "figure.normalise", elapsed, bytes=len(normalised.image.encoded) * 3 // 4
+        )
+
+        self._cache[figure.digest] = normalised
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        return normalised
+
+    def normalise_payload(self, decoded: bytes) -> NormalisedFigure:
+        """Downscale and re-encode the raw image bytes of a figure."""
+        image = PIL.Image.open(BytesIO(decoded)).convert("RGB")
+
+        size = self.target_size(*image.size)
+        if size != image.size:
+            image = image.resize(size, PIL.Image.LANCZOS)
+
+        buffer = BytesIO()
+        image.save(buffer, format=self.image_format, quality=self.quality)
+        payload = buffer.getvalue()
+
+        return NormalisedFigure(
+            image=CompactImage(
+                image,
+                base64.b64encode(payload).decode("ascii"),
+                MIME_TYPES.get(self.image_format, "image/jpeg"),
+            ),
+            digest=hashlib.sha256(payload).hexdigest(),
+            perceptual_hash=difference_hash(image),
+        )
+
+    def clear(self) -> None:
+        """Drop the cached normalised figures."""
+        self._cache.clear()
+
+    def select(self) -> FigureSelection:
+        """Start selecting the figures for a new turn."""
+        return FigureSelection(self)
+
+
+load_environment()
+FIGURE_PREPROCESSOR = FigurePreprocessor()
@@ -0,0 +1,542 @@
+"""Local, in-process replica of the Azure Search index for small, stable corpora.
+
+A snapshot is a directory exported from the remote index:
+    manifest.json     Index name, export time and document count.
+    documents.jsonl   ChunkId, Title and Chunk per document, with the offset and
+                      length of each figure in figures.bin.
+    figures.bin       The base64 figure payloads, memory-mapped.
+    embeddings.npy    Normalised chunk embeddings, memory-mapped. Optional.
+
+Usage:
+    python -m local_index export --output snapshots/image-processing-index
+    python -m local_index info snapshots/image-processing-index
+    python -m local_index query snapshots/image-processing-index "How is Shein innovating?"
+"""
+
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from pathlib import Path
+from preview import clear_previews
+from query_planning import STOP_WORDS, stem
+from search_cache import SEARCH_RESULT_CACHE
+from settings import load_environment
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import mmap
+import numpy as np
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+
+def tokenise(text: str) -> list[str]:
+    return [
+        stem(word)
+        for word in re.findall(r"\w+", text.lower())
+        if len(word) > 1 and word not in STOP_WORDS
+    ]
+
+
+class QueryEmbedder:
+    """Embeds queries with the deployment that produced the index's chunk embeddings."""
+
+    def __init__(self, deployment: str, cache_size: int = 1024):
+        from models import get_http_client
+        from openai import AsyncAzureOpenAI
+
+        self.deployment = deployment
+        self.cache_size = cache_size
+        self.client = AsyncAzureOpenAI(
+            api_version=os.environ["OpenAI__ApiVersion"],
+            azure_endpoint=os.environ["OpenAI__Endpoint"],
+            http_client=get_http_client(),
+        )
+        self._cache: OrderedDict[str, np.ndarray] = OrderedDict()
+
+    async def embed(self, query: str) -> np.ndarray:
+        key = " ".join(query.lower().split())
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        response = await self.client.embeddings.create(
+            model=self.deployment, input=query
+        )
+        embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+        embedding /= np.linalg.norm(embedding) or 1.0
+
+        self._cache[key] = embedding
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        return embedding
+
+
+class LocalIndex:
+    """Hybrid BM25 and vector retrieval over an exported snapshot of the index.
+
+    Each document is scored as a weighted sum of the cosine similarity of its
+    embedding to the query and a lexical score. The lexical score is the
+    IDF-weighted share of the query's terms the document contains, scaled by its
+    BM25 score relative to the best match. Both parts are absolute, so the top
+    score says how confident the local answer is; below `min_confidence` the
+    caller falls back to the remote index.
+
+    Scores are reported on the semantic reranker's 0-4 scale so the search
+    tool's reranker threshold applies unchanged.
+
+    At most every `refresh_interval` seconds a search checks whether the
+    snapshot has been replaced, e.g. by `export`, and if so reloads it in a
+    worker thread and calls the `on_reload` callbacks."""
+
+    def __init__(
+        self,
+        path: Path,
+        embedder: QueryEmbedder | None = None,
+        vector_weight: float = None,
+        min_confidence: float = None,
+        k1: float = 1.2,
+        b: float = 0.75,
+        refresh_interval: float = None,
+    ):
+        if vector_weight is None:
+            vector_weight = float(os.environ.get("LocalIndex__VectorWeight", 0.5))
+        if min_confidence is None:
+            min_confidence = float(os.environ.get("LocalIndex__MinConfidence", 0.6))
+        if refresh_interval is None:
+            refresh_interval = float(os.environ.get("LocalIndex__RefreshInterval", 30))
+
+        self.path = Path(path)
+        self.min_confidence = min_confidence
+        self.k1 = k1
+        self.b = b
+        self.refresh_interval = refresh_interval
+
+        # Kept to build the replacement when the snapshot is reloaded
+        self.options = {
+            "embedder": embedder,
+            "vector_weight": vector_weight,
+            "min_confidence": min_confidence,
+            "k1": k1,
+            "b": b,
+            "refresh_interval": refresh_interval,
+        }
+        self.on_reload: list = []
+        self.checked_at = time.monotonic()
+        self._reloading = False
+
+        self.stamp = self.manifest_stamp()
+        with open(self.path / "manifest.json") as manifest_file:
+            self.manifest = json.load(manifest_file)
+
+        self.documents = []
+        with open(self.path / "documents.jsonl") as documents_file:
+            for line in documents_file:
+                self.documents.append(json.loads(line))
+
+        self._figures_file = open(self.path / "figures.bin", "rb")
+        self._figures = (
+            mmap.mmap(self._figures_file.fileno(), 0, access=mmap.ACCESS_READ)
+            if os.fstat(self._figures_file.fileno()).st_size
+            else b""
+        )
+
+        embeddings_path = self.path / "embeddings.npy"
+        self.embeddings = (
+            np.load(embeddings_path, mmap_mode="r")
+            if embeddings_path.exists()
+            else None
+        )
+
+        # Without query embeddings only the lexical score can be used
+        self.embedder = embedder if self.embeddings is not None else None
+        self.vector_weight = vector_weight if self.embedder is not None else 0.0
+
+        self.build_lexical_index()
+
+    @property
+    def version(self) -> str:
+        return self.manifest["exported_at"]
+
+    def manifest_stamp(self) -> tuple[int, int]:
+        """Identify the manifest file. `export` swaps in a new directory, so both
+        the inode and the modification time change."""
+        stat = os.stat(self.path / "manifest.json")
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    async def refresh(self) -> bool:
+        """Reload the snapshot if it has been replaced since it was loaded.
+
+        Returns:
+            bool: True if a new snapshot was loaded."""
+        now = time.monotonic()
+        if self._reloading or now - self.checked_at < self.refresh_interval:
+            return False
+        self.checked_at = now
+
+        try:
+            if self.manifest_stamp() == self.stamp:
+                return False
+        except OSError:
+            # Mid swap, check again next time
+            return False
+
+        self._reloading = True
+        try:
+            fresh = await asyncio.to_thread(LocalIndex, self.path, **self.options)
+        except (OSError, KeyError, ValueError):
+            logging.exception("Unable to reload the local index from %s", self.path)
+            return False
+        finally:
+            self._reloading = False
+
+        previous_version = self.version
+        self.swap(fresh)
+        logging.info(
+            "Reloaded the local index, version %s replaces %s",
+            self.version,
+            previous_version,
+        )
+
+        for callback in self.on_reload:
+            callback()
+
+        return True
+
+    def swap(self, fresh: "LocalIndex") -> None:
+        """Take over the state of a freshly loaded snapshot and release the old one.
+
+        Runs without awaiting, so no search sees a mix of the two."""
+        figures, figures_file = self._figures, self._figures_file
+        on_reload = self.on_reload
+
+        self.__dict__.update(fresh.__dict__)
+        self.on_reload = on_reload
+
+        # Figure payloads are copied out of the map, so nothing still views it
+        if isinstance(figures, mmap.mmap):
+            figures.close()
+        figures_file.close()
+
+    def build_lexical_index(self) -> None:
+        """Build the inverted index used for BM25 scoring."""
+        postings: dict[str, tuple[list[int], list[int]]] = {}
+        lengths = []
+
+        for index, document in enumerate(self.documents):
+            terms = Counter(tokenise(f"{document['Title']} {document['Chunk']}"))
+            lengths.append(sum(terms.values()))
+
+            for term, frequency in terms.items():
+                documents, frequencies = postings.setdefault(term, ([], []))
+                documents.append(index)
+                frequencies.append(frequency)
+
+        self.document_lengths = np.asarray(lengths, dtype=np.float32)
+        self.average_length = float(self.document_lengths.mean()) if lengths else 0.0
+
+        count = len(self.documents)
+        self.postings = {
+            term: (
+                np.asarray(documents, dtype=np.int32),
+                np.asarray(frequencies, dtype=np.float32),
+                math.log(1 + (count - len(documents) + 0.5) / (len(documents) + 0.5)),
+            )
+            for term, (documents, frequencies) in postings.items()
+        }
+
+    def lexical_scores(self, query: str) -> np.ndarray:
+        count = len(self.documents)
+        bm25 = np.zeros(count, dtype=np.float32)
+        matched = np.zeros(count, dtype=np.float32)
+
+        terms = set(tokenise(query))
+        if not terms or not count:
+            return bm25
+
+        # Terms missing from the corpus still count towards the query's weight
+        missing_idf = math.log(1 + (count + 0.5) / 0.5)
+        total_idf = 0.0
+
+        for term in terms:
+            if term not in self.postings:
+                total_idf += missing_idf
+                continue
+
+            documents, frequencies, idf = self.postings[term]
+            total_idf += idf
+
+            normalised_length = (
+                1
+                - self.b
+                + self.b * (self.document_lengths[documents] / self.average_length)
+            )
+            bm25[documents] += (
+                idf
+                * frequencies
+                * (self.k1 + 1)
+                / (frequencies + self.k1 * normalised_length)
+            )
+            matched[documents] += idf
+
+        best = bm25.max()
+        if best <= 0:
+            return bm25
+
+        return (matched / total_idf) * (bm25 / best)
+
+    def figure_data(self, figure: dict) -> str:
+        offset, length = figure["Offset"], figure["Length"]
+        return bytes(self._figures[offset : offset + length]).decode("ascii")
+
+    def result(self, index: int, score: float) -> dict:
+        """Build a result in the shape the remote index returns."""
+        document = self.documents[index]
+
+        return {
+            "ChunkId": document["ChunkId"],
+            "Title": document["Title"],
+            "Chunk": document["Chunk"],
+            "ChunkFigures": [
+                {"FigureId": figure["FigureId"], "Data": self.figure_data(figure)}
+                for figure in document["ChunkFigures"]
+            ],
+            "@search.reranker_score": 4 * score,
+        }
+
+    async def search(self, query: str, top: int) -> list[dict] | None:
+        """Search the snapshot.
+
+        Args:
+            query (str): The search term.
+            top (int): The number of results to return.
+
+        Returns:
+            list[dict] | None: The results, or None if the best match is below the
+                confidence threshold and the remote index should be used."""
+        await self.refresh()
+
+        embedding = None
+        if self.vector_weight:
+            embedding = await self.embedder.embed(query)
+
+        # Nothing below awaits, so a reload cannot swap the snapshot mid search
+        if not self.documents:
+            return None
+
+        vector_weight = self.vector_weight if embedding is not None else 0.0
+        scores = (1 - vector_weight) * self.lexical_scores(query)
+
+        if vector_weight and self.embeddings.shape[1] == len(embedding):
+            scores += vector_weight * np.clip(self.embeddings @ embedding, 0, 1)
+
+        top = min(top, len(scores))
+        best = np.argpartition(-scores, top - 1)[:top]
+        best = best[np.argsort(-scores[best])]
+
+        if scores[best[0]] < self.min_confidence:
+            logging.info(
+                "Local index confidence %.2f too low for %s", scores[best[0]], query
+            )
+            return None
+
+        return [self.result(index, float(scores[index])) for index in best]
+
+    def close(self) -> None:
+        if isinstance(self._figures, mmap.mmap):
+            self._figures.close()
+        self._figures_file.close()
+
+
+async def export_index(
+    output: Path, index_name: str, include_embeddings: bool = True
+) -> dict:
+    """Export the remote index to a snapshot directory, replacing any existing one.
+
+    Args:
+        output (Path): The snapshot directory.
+        index_name (str): The remote index to export.
+        include_embeddings (bool, optional): Export the chunk embeddings, which
+            must be retrievable in the index. Defaults to True.
+
+    Returns:
+        dict: The snapshot manifest."""
+    from search_client_pool import SearchClientPool
+
+    pool = SearchClientPool(index_name=index_name, pool_size=1)
+    output = Path(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+
+    # Write next to the target and swap it in, so a running app never sees half
+    # a snapshot
+    staging = Path(tempfile.mkdtemp(prefix=f".{output.name}-", dir=output.parent))
+    staging.chmod(0o755)
+    embeddings = []
+    figure_offsets: dict[bytes, int] = {}
+    count = 0
+
+    try:
+        with open(staging / "documents.jsonl", "w") as documents_file, open(
+            staging / "figures.bin", "wb"
+        ) as figures_file:
+            async with pool.acquire() as search_client:
+                fields = ["ChunkId", "Title", "Chunk", "ChunkFigures"]
+                if include_embeddings:
+                    fields.append("ChunkEmbedding")
+
+                results = await search_client.search(
+                    search_text="*", select=",".join(fields)
+                )
+
+                async for result in results:
+                    figures = []
+                    for figure in result.get("ChunkFigures") or []:
+                        payload = figure["Data"].encode("ascii")
+
+                        # Figures repeated across chunks are written once
+                        digest = hashlib.sha256(payload).digest()
+                        if digest not in figure_offsets:
+                            figure_offsets[digest] = figures_file.tell()
+                            figures_file.write(payload)
+
+                        figures.append(
+                            {
+                                "FigureId": figure["FigureId"],
+                                "Offset": figure_offsets[digest],
+                                "Length": len(payload),
+                            }
+                        )
+
+                    documents_file.write(
+                        json.dumps(
+                            {
+                                "ChunkId": result["ChunkId"],
+                                "Title": result["Title"],
+                                "Chunk": result["Chunk"],
+                                "ChunkFigures": figures,
+                            }
+                        )
+                        + "\n"
+                    )
+
+                    if result.get("ChunkEmbedding") is not None:
+                        embeddings.append(result["ChunkEmbedding"])
+                    count += 1
+
+        if embeddings and len(embeddings) == count:
+            matrix = np.asarray(embeddings, dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            np.save(staging / "embeddings.npy", matrix / np.where(norms, norms, 1))
+        elif embeddings:
+            logging.warning("Some chunks have no embedding, exporting lexical only")
+
+        manifest = {
+            "index_name": index_name,
+            "exported_at": datetime.now(timezone.utc).isoformat(),
+            "documents": count,
+            "embedding_dimensions": len(embeddings[0]) if embeddings else None,
+        }
+        with open(staging / "manifest.json", "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+
+        if output.exists():
+            retired = output.with_name(f".{output.name}-retired")
+            shutil.rmtree(retired, ignore_errors=True)
+            output.rename(retired)
+            staging.rename(output)
+            shutil.rmtree(retired, ignore_errors=True)
+        else:
+            staging.rename(output)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    finally:
+        await pool.close()
+
+    return manifest
+
+
+def load_local_index(path: str = None) -> LocalIndex | None:
+    """Load the configured snapshot, or None if no usable snapshot is configured."""
+    if path is None:
+        path = os.environ.get("LocalIndex__Path")
+    if not path:
+        return None
+
+    embedding_deployment = os.environ.get("OpenAI__EmbeddingDeployment")
+
+    try:
+        embedder = QueryEmbedder(embedding_deployment) if embedding_deployment else None
+        return LocalIndex(path, embedder=embedder)
+    except (OSError, KeyError, ValueError):
+        logging.exception("Unable to load the local index from %s", path)
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Manage local index snapshots.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="Export the remote index.")
+    export_parser.add_argument("--output", type=Path, required=True)
+    export_parser.add_argument("--index", default="image-processing-index")
+    export_parser.add_argument(
+        "--no-embeddings",
+        action="store_true",
+        help="Skip the chunk embeddings, e.g. if they are not retrievable.",
+    )
+
+    info_parser = commands.add_parser("info", help="Describe a snapshot.")
+    info_parser.add_argument("path", type=Path)
+
+    query_parser = commands.add_parser("query", help="Search a snapshot.")
+    query_parser.add_argument("path", type=Path)
+    query_parser.add_argument("query")
+    query_parser.add_argument("--top", type=int, default=4)
+
+    arguments = parser.parse_args()
+
+    if arguments.command == "export":
+        manifest = asyncio.run(
+            export_index(
+                arguments.output,
+                arguments.index,
+                include_embeddings=not arguments.no_embeddings,
+            )
+        )
+        print(json.dumps(manifest, indent=4))
+    elif arguments.command == "info":
+        print(json.dumps(LocalIndex(arguments.path).manifest, indent=4))
+    else:
+        local_index = load_local_index(str(arguments.path))
+        if local_index is None:
+            return 1
+
+        results = asyncio.run(local_index.search(arguments.query, arguments.top))
+        if results is None:
+            print("No confident local results")
+            return 1
+
+        for result in results:
+            print(
+                f"{result['@search.reranker_score']:.2f} {result['ChunkId']} {result['Title']}"
+            )
+
+    return 0
+
+
+load_environment()
+LOCAL_INDEX = load_local_index()
+if LOCAL_INDEX is not None:
+    # Results and previews cached from the old snapshot are stale once it is replaced
+    LOCAL_INDEX.on_reload.extend([SEARCH_RESULT_CACHE.invalidate, clear_previews])
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,33 +1,212 @@
+from autogen_core import CancellationToken
+from autogen_core.models import (
+    ChatCompletionClient,
+    CreateResult,
+    LLMMessage,
+    ModelInfo,
+    RequestUsage,
+)
+from autogen_core.tools import Tool, ToolSchema
 from autogen_ext.models.openai import AzureOpenAIChatCompletionClient
+from settings import load_environment
+from tracing import TRACER
+from typing import Any, AsyncGenerator, Mapping, Sequence
+import httpx
 import os
-from dotenv import load_dotenv, find_dotenv
-
-load_dotenv(find_dotenv())
-# Setup Models
-GPT_4O_MODEL = AzureOpenAIChatCompletionClient(
-    azure_deployment=os.environ["OpenAI__CompletionDeployment"],
-    model=os.environ["OpenAI__CompletionDeployment"],
-    api_version=os.environ["OpenAI__ApiVersion"],
-    azure_endpoint=os.environ["OpenAI__Endpoint"],
-    azure_ad_token_provider=None,
-    model_capabilities={
-        "vision": False,
-        "function_calling": True,
-        "json_output": True,
-    },
-    temperature=0,
-)
+import time
 
-GPT_4O_MINI_MODEL = AzureOpenAIChatCompletionClient(
-    azure_deployment=os.environ["OpenAI__CompletionDeployment"],
-    model=os.environ["OpenAI__CompletionDeployment"],
-    api_version=os.environ["OpenAI__ApiVersion"],
-    azure_endpoint=os.environ["OpenAI__Endpoint"],
-    azure_ad_token_provider=None,
-    model_capabilities={
-        "vision": False,
-        "function_calling": True,
-        "json_output": True,
-    },
-    temperature=0,
-)
+# Environment variable holding the deployment for each model role. The mini role
+# falls back to the main completion deployment, in which case both roles share a
+# single client.
+MODEL_DEPLOYMENTS = {
+    "gpt-4o": "OpenAI__CompletionDeployment",
+    "gpt-4o-mini": "OpenAI__MiniCompletionDeployment",
+}
+
+_http_client: httpx.AsyncClient | None = None
+_model_clients: dict[tuple, ChatCompletionClient] = {}
+_registered_clients: dict[str, ChatCompletionClient] = {}
+_traced_clients: dict[str, "TracedChatCompletionClient"] = {}
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Get the pooled HTTP transport shared by every model client."""
+    global _http_client
+
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=int(os.environ.get("OpenAI__MaxConnections", 100)),
+                max_keepalive_connections=int(
+                    os.environ.get("OpenAI__MaxKeepAliveConnections", 20)
+                ),
+            ),
+            timeout=httpx.Timeout(600, connect=5),
+        )
+
+    return _http_client
+
+
+def register_model_client(role: str, client: ChatCompletionClient) -> None:
+    """Use the given client for a model role instead of building one.
+
+    Args:
+        role (str): The model role, e.g. "gpt-4o".
+        client (ChatCompletionClient): The client to use."""
+    _registered_clients[role] = client
+
+
+class TracedChatCompletionClient(ChatCompletionClient):
+    """Wraps a model client to record a span for every model call.
+
+    Streamed calls also record the time to the first token."""
+
+    def __init__(self, client: ChatCompletionClient, role: str):
+        self.client = client
+        self.role = role
+
+    async def create(
+        self,
+        messages: Sequence[LLMMessage],
+        *,
+        tools: Sequence[Tool | ToolSchema] = [],
+        json_output: bool | None = None,
+        extra_create_args: Mapping[str, Any] = {},
+        cancellation_token: CancellationToken | None = None,
+    ) -> CreateResult:
+        with TRACER.span(
+            "model.call", role=self.role, mode="create", messages=len(messages)
+        ) as span:
+            result = await self.client.create(
+                messages,
+                tools=tools,
+                json_output=json_output,
+                extra_create_args=extra_create_args,
+                cancellation_token=cancellation_token,
+            )
+            span.set(
+                prompt_tokens=result.usage.prompt_tokens,
+                completion_tokens=result.usage.completion_tokens,
+            )
+
+        return result
+
+    async def create_stream(
+        self,
+        messages: Sequence[LLMMessage],
+        *,
+        tools: Sequence[Tool | ToolSchema] = [],
+        json_output: bool | None = None,
+        extra_create_args: Mapping[str, Any] = {},
+        cancellation_token: CancellationToken | None = None,
+    ) -> AsyncGenerator[str | CreateResult, None]:
+        with TRACER.span(
+            "model.call", role=self.role, mode="stream", messages=len(messages)
+        ) as span:
+            started = time.perf_counter()
+            chunks = 0
+
+            async for chunk in self.client.create_stream(
+                messages,
+                tools=tools,
+                json_output=json_output,
+                extra_create_args=extra_create_args,
+                cancellation_token=cancellation_token,
+            ):
+                if isinstance(chunk, str):
+                    if chunks == 0:
+                        span.set(ttft=time.perf_counter() - started)
+                    chunks += 1
+                else:
+                    span.set(
+                        prompt_tokens=chunk.usage.prompt_tokens,
+                        completion_tokens=chunk.usage.completion_tokens,
+                    )
+
+                yield chunk
+
+            span.set(chunks=chunks)
+
+    def actual_usage(self) -> RequestUsage:
+        return self.client.actual_usage()
+
+    def total_usage(self) -> RequestUsage:
+        return self.client.total_usage()
+
+    def count_tokens(
+        self, messages: Sequence[LLMMessage], *, tools: Sequence[Tool | ToolSchema] = []
+    ) -> int:
+        return self.client.count_tokens(messages, tools=tools)
+
+    def remaining_tokens(
+        self, messages: Sequence[LLMMessage], *, tools: Sequence[Tool | ToolSchema] = []
+    ) -> int:
+        return self.client.remaining_tokens(messages, tools=tools)
+
+    @property
+    def capabilities(self) -> ModelInfo:
+        return self.client.model_info
+
+    @property
+    def model_info(self) -> ModelInfo:
+        return self.client.model_info
+
+
+def traced(role: str, client: ChatCompletionClient) -> ChatCompletionClient:
+    """Wrap the client for tracing, if tracing is enabled."""
+    if not TRACER.enabled:
+        return client
+
+    traced_client = _traced_clients.get(role)
+    if traced_client is None or traced_client.client is not client:
+        traced_client = _traced_clients[role] = TracedChatCompletionClient(client, role)
+
+    return traced_client
+
+
+def get_model_client(role: str) -> ChatCompletionClient:
+    """Get the client for a model role, creating it on first use.
+
+    Clients are keyed by their configuration, so roles configured with the same
+    deployment share one client.
+
+    Args:
+        role (str): The model role, e.g. "gpt-4o".
+
+    Returns:
+        ChatCompletionClient: The model client."""
+    if role in _registered_clients:
+        return traced(role, _registered_clients[role])
+
+    load_environment()
+
+    deployment = os.environ.get(
+        MODEL_DEPLOYMENTS[role], os.environ["OpenAI__CompletionDeployment"]
+    )
+    key = (deployment, os.environ["OpenAI__ApiVersion"], os.environ["OpenAI__Endpoint"])
+
+    if key not in _model_clients:
+        _model_clients[key] = AzureOpenAIChatCompletionClient(
+            azure_deployment=deployment,
+            model=deployment,
+            api_version=os.environ["OpenAI__ApiVersion"],
+            azure_endpoint=os.environ["OpenAI__Endpoint"],
+            azure_ad_token_provider=None,
+            model_capabilities={
+                "vision": False,
+                "function_calling": True,
+                "json_output": True,
+            },
+            temperature=0,
+            http_client=get_http_client(),
+        )
+
+    return traced(role, _model_clients[key])
+
+
+def gpt_4o_model() -> ChatCompletionClient:
+    return get_model_client("gpt-4o")
+
+
+def gpt_4o_mini_model() -> ChatCompletionClient:
+    return get_model_client("gpt-4o-mini")
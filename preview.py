@@ -0,0 +1,204 @@
+from collections import OrderedDict
+
+PREVIEW_CACHE_SIZE = 4096
+
+# (chunk_id, length) -> preview
+_previews: OrderedDict[tuple[str, int], str] = OrderedDict()
+
+
+def skip_line_marker(text: str, index: int) -> int:
+    """Skip a Markdown header, blockquote or list marker at the start of a line.
+
+    Args:
+        text (str): The text being rendered.
+        index (int): Index of the start of the line.
+
+    Returns:
+        int: Index of the first character after the marker."""
+    length = len(text)
+    position = index
+
+    while position < length and text[position] in " \t":
+        position += 1
+
+    if position >= length:
+        return index
+
+    character = text[position]
+
+    if character == "#":
+        end = position
+        while end < length and end - position < 6 and text[end] == "#":
+            end += 1
+        while end < length and text[end] in " \t":
+            end += 1
+        return end
+
+    if character == ">":
+        end = position + 1
+        if end < length and text[end] == " ":
+            end += 1
+        return end
+
+    if character in "-+*" and position + 1 < length and text[position + 1] in " \t":
+        end = position + 1
+        while end < length and text[end] in " \t":
+            end += 1
+        return end
+
+    if character.isdigit():
+        end = position
+        while end < length and text[end].isdigit():
+            end += 1
+        if end + 1 < length and text[end] == "." and text[end + 1] in " \t":
+            end += 1
+            while end < length and text[end] in " \t":
+                end += 1
+            return end
+
+    return index
+
+
+def find_emphasis_close(text: str, index: int) -> tuple[int, int] | None:
+    """Find the marker closing the `*` or `**` emphasis opened at the index.
+
+    A marker only counts as emphasis when it is closed on the same line, so a
+    lone asterisk, as in "3*4" or a footnote mark, is kept.
+
+    Args:
+        text (str): The text being rendered.
+        index (int): Index of the opening asterisk.
+
+    Returns:
+        tuple[int, int] | None: Index and length of the closing marker, or None if
+            the asterisk does not open emphasis."""
+    line_end = text.find("\n", index)
+    if line_end == -1:
+        line_end = len(text)
+
+    for marker in ("**", "*"):
+        if not text.startswith(marker, index):
+            continue
+
+        close = text.find(marker, index + len(marker), line_end)
+        if close != -1:
+            return close, len(marker)
+
+    return None
+
+
+def render_preview(text: str, length: int) -> str:
+    """Render the first `length` visible characters of Markdown text as plain text.
+
+    The text is walked once and rendering stops as soon as enough characters have
+    been produced. Matched emphasis markers, code markers, images, link targets
+    and figure placeholders are removed, and new lines become spaces.
+
+    Args:
+        text (str): The Markdown text.
+        length (int): The number of visible characters to produce.
+
+    Returns:
+        str: The plain text preview."""
+    output = []
+    count = 0
+    index = 0
+    text_length = len(text)
+    line_start = True
+    # Index of each pending closing emphasis marker -> its length
+    closing: dict[int, int] = {}
+
+    while index < text_length and count < length:
+        if line_start:
+            line_start = False
+            index = skip_line_marker(text, index)
+            continue
+
+        character = text[index]
+
+        if character == "\n":
+            output.append(" ")
+            count += 1
+            index += 1
+            line_start = True
+            continue
+
+        if index in closing:
+            index += closing.pop(index)
+            continue
+
+        if character == "*":
+            emphasis = find_emphasis_close(text, index)
+            if emphasis is not None:
+                close, marker_length = emphasis
+                closing[close] = marker_length
+                index += marker_length
+                continue
+
+        if character == "`":
+            index += 1
+            continue
+
+        if character == "_":
+            previous_is_word = index > 0 and text[index - 1].isalnum()
+            next_is_word = index + 1 < text_length and text[index + 1].isalnum()
+            if not (previous_is_word and next_is_word):
+                index += 1
+                continue
+
+        if character == "<" and text.startswith("<figure", index):
+            end = text.find(">", index)
+            if end != -1:
+                index = end + 1
+                continue
+
+        is_image = character == "!" and text.startswith("[", index + 1)
+        if character == "[" or is_image:
+            open_bracket = index + 1 if is_image else index
+            close_bracket = text.find("]", open_bracket + 1)
+            if close_bracket != -1 and text.startswith("(", close_bracket + 1):
+                close_paren = text.find(")", close_bracket + 2)
+                if close_paren != -1:
+                    if not is_image:
+                        link_text = text[open_bracket + 1 : close_bracket]
+                        link_text = link_text[: length - count]
+                        output.append(link_text)
+                        count += len(link_text)
+                    index = close_paren + 1
+                    continue
+
+        output.append(character)
+        count += 1
+        index += 1
+
+    return "".join(output)
+
+
+def chunk_preview(chunk_id: str, text: str, length: int = 150) -> str:
+    """Get the plain text preview for a chunk, memoised per ChunkId.
+
+    Args:
+        chunk_id (str): The chunk's ID.
+        text (str): The chunk's Markdown text.
+        length (int, optional): The number of visible characters. Defaults to 150.
+
+    Returns:
+        str: The plain text preview."""
+    key = (chunk_id, length)
+
+    if key in _previews:
+        _previews.move_to_end(key)
+        return _previews[key]
+
+    preview = render_preview(text, length)
+    _previews[key] = preview
+
+    if len(_previews) > PREVIEW_CACHE_SIZE:
+        _previews.popitem(last=False)
+
+    return preview
+
+
+def clear_previews() -> None:
+    """Drop the memoised previews, e.g. after the index has been rebuilt."""
+    _previews.clear()
@@ -0,0 +1,167 @@
+from collections import OrderedDict
+from search_cache import SearchResultCache
+from settings import load_environment
+from typing import NamedTuple
+import asyncio
+import logging
+import os
+
+
+class WarmSearch(NamedTuple):
+    # The search term
+    query: str
+    # The results fetched for it, the top the search cache is keyed on
+    top: int
+    # The tool mode, e.g. "rag"
+    mode: str
+
+
+def question_key(question: str, agent: str) -> tuple[str, str]:
+    return (SearchResultCache.normalise_query(question).rstrip("?!. "), agent)
+
+
+class SearchHistory:
+    """Remembers the searches each question led to and how often each search runs.
+
+    Both are bounded LRUs, so the popular searches are the most frequent among
+    the recent ones."""
+
+    def __init__(self, max_questions: int = None, max_searches: int = None):
+        if max_questions is None:
+            max_questions = int(os.environ.get("Prewarm__MaxQuestions", 256))
+        if max_searches is None:
+            max_searches = int(os.environ.get("Prewarm__MaxSearches", 1024))
+
+        self.max_questions = max_questions
+        self.max_searches = max_searches
+
+        # (normalised question, agent) -> the searches made answering it
+        self.questions: OrderedDict[tuple[str, str], list[WarmSearch]] = OrderedDict()
+        # (agent, search) -> times run
+        self.counts: OrderedDict[tuple[str, WarmSearch], int] = OrderedDict()
+
+    def record(self, question: str, agent: str, searches: list[WarmSearch]) -> None:
+        """Record the searches made answering a question.
+
+        Args:
+            question (str): The user's question.
+            agent (str): The agent choice that answered it.
+            searches (list[WarmSearch]): The searches made, in order."""
+        if not searches:
+            return
+
+        key = question_key(question, agent)
+        self.questions[key] = list(dict.fromkeys(searches))
+        self.questions.move_to_end(key)
+
+        while len(self.questions) > self.max_questions:
+            self.questions.popitem(last=False)
+
+        for search in searches:
+            self.counts[(agent, search)] = self.counts.get((agent, search), 0) + 1
+            self.counts.move_to_end((agent, search))
+
+        while len(self.counts) > self.max_searches:
+            self.counts.popitem(last=False)
+
+    def searches_for(self, question: str, agent: str) -> list[WarmSearch]:
+        key = question_key(question, agent)
+        return self.questions.get(key, [])
+
+    def popular(self, agent: str, count: int) -> list[WarmSearch]:
+        """The most frequent recent searches for the agent choice."""
+        searches = [
+            (times, search)
+            for (search_agent, search), times in self.counts.items()
+            if search_agent == agent and times > 1
+        ]
+        searches.sort(key=lambda item: item[0], reverse=True)
+
+        return [search for _, search in searches[:count]]
+
+
+class Prewarmer:
+    """Plans the searches to run in the background when a session opens.
+
+    The searches the starter questions led to come first, then the popular
+    searches, up to the budget. They are run by the session's SearchTool, which
+    puts the results in the shared search cache and decodes their figures.
+
+    At most `max_concurrency` prewarm searches are in flight across every
+    session, so a burst of new sessions does not crowd out live searches."""
+
+    def __init__(
+        self,
+        history: SearchHistory,
+        enabled: bool = None,
+        max_concurrency: int = None,
+        budget: int = None,
+        popular: int = None,
+    ):
+        if enabled is None:
+            enabled = os.environ.get("Prewarm__Enabled", "true").lower() == "true"
+        if max_concurrency is None:
+            max_concurrency = int(os.environ.get("Prewarm__MaxConcurrency", 2))
+        if budget is None:
+            budget = int(os.environ.get("Prewarm__Budget", 12))
+        if popular is None:
+            popular = int(os.environ.get("Prewarm__PopularSearches", 4))
+
+        self.history = history
+        self.enabled = enabled
+        self.max_concurrency = max_concurrency
+        self.budget = budget
+        self.popular = popular
+
+        self._semaphore: asyncio.Semaphore | None = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def plan(self, questions: list[str], agent: str) -> list[WarmSearch]:
+        """Plan the searches to warm for a session.
+
+        Args:
+            questions (list[str]): The questions the user is likely to ask first.
+            agent (str): The session's agent choice.
+
+        Returns:
+            list[WarmSearch]: The searches, most likely first, within the budget."""
+        searches = {}
+
+        # Interleave the questions so each gets its first searches warmed
+        per_question = [
+            self.history.searches_for(question, agent) for question in questions
+        ]
+        for index in range(max(map(len, per_question), default=0)):
+            for question_searches in per_question:
+                if index < len(question_searches):
+                    searches.setdefault(question_searches[index])
+
+        for search in self.history.popular(agent, self.popular):
+            searches.setdefault(search)
+
+        return list(searches)[: self.budget]
+
+    def start(self, search_tool, questions: list[str], agent: str) -> None:
+        """Start warming the session's SearchTool in the background.
+
+        Args:
+            search_tool (SearchTool): The search tool of the session's team.
+            questions (list[str]): The questions the user is likely to ask first.
+            agent (str): The session's agent choice."""
+        if not self.enabled:
+            return
+
+        searches = self.plan(questions, agent)
+        if searches:
+            logging.info("Prewarming %d searches for %s", len(searches), agent)
+            search_tool.prewarm(searches, self.semaphore)
+
+
+load_environment()
+SEARCH_HISTORY = SearchHistory()
+PREWARMER = Prewarmer(SEARCH_HISTORY)
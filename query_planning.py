@@ -0,0 +1,124 @@
+from typing import NamedTuple
+from settings import load_environment
+import os
+import re
+
+STOP_WORDS = frozenset(
+    "a an and are as at be by for from how in is it its of on or that the their "
+    "this to was what when where which who why with".split()
+)
+
+# Longest suffixes first, each with its replacement
+SUFFIXES = (
+    ("ational", "ate"),
+    ("ization", "ize"),
+    ("fulness", "ful"),
+    ("ousness", "ous"),
+    ("iveness", "ive"),
+    ("ability", ""),
+    ("ments", ""),
+    ("ment", ""),
+    ("ness", ""),
+    ("able", ""),
+    ("ings", ""),
+    ("ing", ""),
+    ("ies", "y"),
+    ("ied", "y"),
+    ("ers", ""),
+    ("er", ""),
+    ("ed", ""),
+    ("ly", ""),
+    ("es", ""),
+    ("s", ""),
+)
+
+
+def stem(word: str) -> str:
+    """Reduce a word to a rough stem by stripping common English suffixes."""
+    for suffix, replacement in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[: -len(suffix)] + replacement
+
+    return word
+
+
+def term_signature(query: str) -> frozenset[str]:
+    """Normalise a search term into the set of its stemmed content words."""
+    words = re.findall(r"\w+", query.lower())
+
+    # Possessives and other single letter fragments carry no meaning
+    stems = frozenset(
+        stem(word) for word in words if len(word) > 1 and word not in STOP_WORDS
+    )
+
+    # A query of only stop words is kept as is rather than collapsing to nothing
+    return stems or frozenset(words)
+
+
+class QueryPlan(NamedTuple):
+    queries: list[str]
+    top: int
+    collapsed: int
+
+
+class QueryPlanner:
+    """Collapses near-duplicate search terms before they are sent to the index.
+
+    Terms are clustered by the Jaccard similarity of their stemmed content words,
+    so paraphrases such as "Shein sustainability approach" and "sustainability
+    approach of Shein" become one query. The results quota saved by collapsing
+    terms is spent on a larger top for the remaining queries."""
+
+    def __init__(self, similarity_threshold: float = None, max_top: int = None):
+        if similarity_threshold is None:
+            similarity_threshold = float(
+                os.environ.get("QueryPlanning__SimilarityThreshold", 0.75)
+            )
+        if max_top is None:
+            max_top = int(os.environ.get("QueryPlanning__MaxTop", 8))
+
+        self.similarity_threshold = similarity_threshold
+        self.max_top = max_top
+
+    def similarity(self, first: frozenset[str], second: frozenset[str]) -> float:
+        if not first or not second:
+            return 0.0
+
+        return len(first & second) / len(first | second)
+
+    def plan(self, queries: list[str], top: int) -> QueryPlan:
+        """Plan the queries to send to the index.
+
+        Args:
+            queries (list[str]): The search terms requested by the agent.
+            top (int): The number of results requested per term.
+
+        Returns:
+            QueryPlan: The representative term for each cluster, in request order,
+                and the number of results to fetch for each."""
+        clusters: list[tuple[str, frozenset[str]]] = []
+
+        for query in queries:
+            signature = term_signature(query)
+
+            is_duplicate = any(
+                self.similarity(signature, cluster_signature)
+                >= self.similarity_threshold
+                for _, cluster_signature in clusters
+            )
+            if not is_duplicate:
+                clusters.append((query, signature))
+
+        if not clusters:
+            return QueryPlan([], top, 0)
+
+        # Keep the total number of results requested the same
+        planned_top = max(top, min((len(queries) * top) // len(clusters), self.max_top))
+
+        return QueryPlan(
+            [query for query, _ in clusters], planned_top, len(queries) - len(clusters)
+        )
+
+
+load_environment()
+QUERY_PLANNER = QueryPlanner()
@@ -0,0 +1,156 @@
+from typing import NamedTuple
+from settings import load_environment
+import math
+import os
+
+POLICIES = ("adaptive", "fixed")
+
+
+class RetrievalPlan(NamedTuple):
+    # Results to request in the first page
+    page_top: int
+    # Results wanted in total, reached by widening with a second page
+    top: int
+    # Vector candidates passed to the reranker
+    knn: int
+
+
+class ScoreStats:
+    """Running reranker score statistics for one tool mode."""
+
+    __slots__ = ("observations", "pass_rate", "mean_score")
+
+    def __init__(self, prior_pass_rate: float):
+        self.observations = 0
+        self.pass_rate = prior_pass_rate
+        self.mean_score = 0.0
+
+    def update(self, pass_rate: float, mean_score: float, smoothing: float) -> None:
+        self.observations += 1
+        self.pass_rate += smoothing * (pass_rate - self.pass_rate)
+
+        if self.observations == 1:
+            self.mean_score = mean_score
+        else:
+            self.mean_score += smoothing * (mean_score - self.mean_score)
+
+
+class RetrievalPlanner:
+    """Sizes each search from the reranker scores seen so far for its tool mode.
+
+    Semantic results come back ordered by reranker score, so if the last result
+    of a page clears the threshold the next page may too, and if it does not,
+    nothing after it will. The adaptive policy therefore asks for a first page
+    sized to the expected number of passing results and only requests the rest
+    of the top, as a second page, when that page scores well. The vector
+    candidate pool shrinks towards `min_knn_multiplier` times top as the pass
+    rate rises.
+
+    The fixed policy keeps the original behaviour: one page of top results over
+    `max_knn_multiplier` times top candidates."""
+
+    def __init__(
+        self,
+        threshold: float = None,
+        policy: str = None,
+        min_knn_multiplier: float = None,
+        max_knn_multiplier: float = None,
+        min_observations: int = None,
+        smoothing: float = 0.2,
+    ):
+        if threshold is None:
+            threshold = float(
+                os.environ.get("AIService__AzureSearchOptions__RerankerThreshold", 2.5)
+            )
+        if policy is None:
+            policy = os.environ.get("RetrievalPlanning__Policy", "adaptive").lower()
+        if min_knn_multiplier is None:
+            min_knn_multiplier = float(
+                os.environ.get("RetrievalPlanning__MinKnnMultiplier", 2)
+            )
+        if max_knn_multiplier is None:
+            max_knn_multiplier = float(
+                os.environ.get("RetrievalPlanning__MaxKnnMultiplier", 5)
+            )
+        if min_observations is None:
+            min_observations = int(
+                os.environ.get("RetrievalPlanning__MinObservations", 5)
+            )
+
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown retrieval policy {policy}, expected {POLICIES}")
+
+        self.threshold = threshold
+        self.policy = policy
+        self.min_knn_multiplier = min_knn_multiplier
+        self.max_knn_multiplier = max_knn_multiplier
+        self.min_observations = min_observations
+        self.smoothing = smoothing
+
+        self.modes: dict[str, ScoreStats] = {}
+
+    def stats_for(self, mode: str) -> ScoreStats:
+        if mode not in self.modes:
+            self.modes[mode] = ScoreStats(prior_pass_rate=1.0)
+        return self.modes[mode]
+
+    def plan(self, mode: str, top: int) -> RetrievalPlan:
+        """Plan a query for the tool mode.
+
+        Args:
+            mode (str): The tool mode, e.g. "rag" or "depth_first".
+            top (int): The number of results requested.
+
+        Returns:
+            RetrievalPlan: The first page size, the total and the kNN."""
+        stats = self.stats_for(mode)
+
+        if self.policy == "fixed" or stats.observations < self.min_observations:
+            return RetrievalPlan(top, top, math.ceil(top * self.max_knn_multiplier))
+
+        page_top = max(1, min(top, math.ceil(top * stats.pass_rate)))
+        multiplier = self.min_knn_multiplier + (
+            self.max_knn_multiplier - self.min_knn_multiplier
+        ) * (1 - stats.pass_rate)
+
+        return RetrievalPlan(page_top, top, max(top, math.ceil(top * multiplier)))
+
+    def should_widen(self, plan: RetrievalPlan, scores: list[float]) -> bool:
+        """Whether to fetch the rest of the results after the first page.
+
+        Args:
+            plan (RetrievalPlan): The plan the first page was fetched with.
+            scores (list[float]): The reranker scores of the first page, in order.
+
+        Returns:
+            bool: True if the page was full and its last result passed."""
+        return (
+            plan.page_top < plan.top
+            and len(scores) == plan.page_top
+            and scores[-1] >= self.threshold
+        )
+
+    def observe(self, mode: str, scores: list[float]) -> None:
+        """Record the reranker scores returned for a query."""
+        if not scores:
+            return
+
+        passed = sum(score >= self.threshold for score in scores)
+        self.stats_for(mode).update(
+            passed / len(scores), sum(scores) / len(scores), self.smoothing
+        )
+
+    @property
+    def stats(self) -> dict:
+        return {
+            mode: {
+                "observations": stats.observations,
+                "pass_rate": stats.pass_rate,
+                "mean_score": stats.mean_score,
+            }
+            for mode, stats in self.modes.items()
+        }
+
+
+load_environment()
+RETRIEVAL_PLANNER = RetrievalPlanner()
@@ -0,0 +1,122 @@
+from collections import OrderedDict
+import logging
+import os
+import time
+from settings import load_environment
+
+
+class SearchResultCache:
+    """Bounded LRU cache of per-query search results with TTL expiry.
+
+    Entries hold the chunk text and handles to the figures in the figure store for
+    each result, so a cache hit can repopulate a session's figures without another
+    network call."""
+
+    def __init__(self, max_bytes: int = None, ttl: float = None):
+        if max_bytes is None:
+            max_bytes = int(
+                os.environ.get(
+                    "AIService__AzureSearchOptions__CacheMaxBytes", 64 * 1024 * 1024
+                )
+            )
+        if ttl is None:
+            ttl = float(os.environ.get("AIService__AzureSearchOptions__CacheTtl", 3600))
+
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        # key -> (expires at, size in bytes, records)
+        self._entries: OrderedDict[tuple, tuple[float, int, list[dict]]] = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalise_query(query: str) -> str:
+        """Normalise the query text so trivially different queries share an entry."""
+        return " ".join(query.lower().split())
+
+    def make_key(
+        self, query: str, top: int, semantic_configuration_name: str, index_name: str
+    ) -> tuple:
+        return (
+            self.normalise_query(query),
+            top,
+            semantic_configuration_name,
+            index_name,
+        )
+
+    @staticmethod
+    def size_of(records: list[dict]) -> int:
+        """Approximate the memory held by a list of result records."""
+        size = 0
+        for record in records:
+            size += len(record["ChunkId"]) + len(record["Title"]) + len(record["Chunk"])
+            # Figure payloads are accounted for by the figure store
+            for figure_id in record["Figures"]:
+                size += len(figure_id)
+
+        return size
+
+    def get(self, key: tuple) -> list[dict] | None:
+        """Get the cached records for the key, or None on a miss."""
+        entry = self._entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, size, records = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return records
+
+    def __contains__(self, key: tuple) -> bool:
+        """Check for a live entry without counting a hit or miss."""
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] >= time.monotonic()
+
+    def set(self, key: tuple, records: list[dict]) -> None:
+        """Store the records for the key, evicting the least recently used entries."""
+        size = self.size_of(records)
+
+        if size > self.max_bytes:
+            logging.info("Search result too large to cache: %i bytes", size)
+            return
+
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = (time.monotonic() + self.ttl, size, records)
+        self.current_bytes += size
+
+        while self.current_bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+
+    def _remove(self, key: tuple) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def invalidate(self) -> None:
+        """Drop every entry. Call this when the index has been rebuilt."""
+        self._entries.clear()
+        self.current_bytes = 0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+load_environment()
+SEARCH_RESULT_CACHE = SearchResultCache()
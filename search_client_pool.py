@@ -0,0 +1,107 @@
+from azure.search.documents.aio import SearchClient
+from azure.core.credentials import AzureKeyCredential
+from contextlib import asynccontextmanager
+from collections import deque
+from typing import AsyncIterator
+import asyncio
+import logging
+import os
+import time
+from settings import load_environment
+
+
+class SearchClientPool:
+    """Process-wide pool of async SearchClients.
+
+    Each client owns a keep-alive HTTP session, so handing the same clients out
+    across queries, tool calls and user sessions avoids paying for TLS and
+    connection setup on every search."""
+
+    def __init__(
+        self,
+        index_name: str = "image-processing-index",
+        pool_size: int = None,
+        idle_timeout: float = None,
+    ):
+        self.index_name = index_name
+
+        if pool_size is None:
+            pool_size = int(
+                os.environ.get("AIService__AzureSearchOptions__PoolSize", 8)
+            )
+        if idle_timeout is None:
+            idle_timeout = float(
+                os.environ.get("AIService__AzureSearchOptions__PoolIdleTimeout", 300)
+            )
+
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+
+        # (client, last used) pairs, most recently released on the right
+        self._idle: deque[tuple[SearchClient, float]] = deque()
+        self._size = 0
+        self._condition: asyncio.Condition | None = None
+
+    def create_client(self) -> SearchClient:
+        """Create a new client against the configured index."""
+        return SearchClient(
+            endpoint=os.environ["AIService__AzureSearchOptions__Endpoint"],
+            index_name=self.index_name,
+            credential=AzureKeyCredential(
+                os.environ["AIService__AzureSearchOptions__Key"]
+            ),
+        )
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def evict_idle(self) -> None:
+        """Close clients that have been idle for longer than the idle timeout."""
+        now = time.monotonic()
+        expired = []
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            expired.append(self._idle.popleft()[0])
+
+        for client in expired:
+            self._size -= 1
+            await client.close()
+
+        if expired:
+            logging.info("Evicted %i idle search clients", len(expired))
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[SearchClient]:
+        """Borrow a client from the pool, waiting if every client is in use."""
+        async with self.condition:
+            await self.evict_idle()
+
+            while not self._idle and self._size >= self.pool_size:
+                await self.condition.wait()
+
+            if self._idle:
+                client = self._idle.pop()[0]
+            else:
+                client = self.create_client()
+                self._size += 1
+
+        try:
+            yield client
+        finally:
+            async with self.condition:
+                self._idle.append((client, time.monotonic()))
+                self.condition.notify()
+
+    async def close(self) -> None:
+        """Close every idle client. Called on app shutdown."""
+        async with self.condition:
+            while self._idle:
+                client = self._idle.pop()[0]
+                self._size -= 1
+                await client.close()
+
+
+load_environment()
+SEARCH_CLIENT_POOL = SearchClientPool()
@@ -0,0 +1,130 @@
+from session_state import SessionState
+import json
+
+
+class SearchResult:
+    """A retrieved chunk, as held in process for the UI and the answer agents."""
+
+    __slots__ = ("chunk_id", "title", "chunk", "reranker_score")
+
+    def __init__(self, chunk_id: str, title: str, chunk: str, reranker_score: float):
+        self.chunk_id = chunk_id
+        self.title = title
+        self.chunk = chunk
+        self.reranker_score = reranker_score
+
+
+class SearchResultRegistry:
+    """Per-turn registry of search results keyed by the serialized tool output.
+
+    The search tool serializes its results once for the LLM tool-call message and
+    registers the structured results against that string, so the UI and the
+    answer agents can read them back without parsing the JSON again.
+
+    With a session state backend the results are also stored for the session,
+    so another worker can `load` them.
+
+    Args:
+        session_id (str, optional): The session the results belong to.
+        backend (SessionState, optional): Backend to store the results in.
+    """
+
+    def __init__(self, session_id: str = None, backend: SessionState = None):
+        self.session_id = session_id
+        self.backend = backend if session_id is not None else None
+
+        self._results: dict[str, dict[str, SearchResult]] = {}
+
+    def register(self, results: dict[str, SearchResult]) -> str:
+        """Register the results and return their serialized form.
+
+        Args:
+            results (dict[str, SearchResult]): The results keyed by ChunkId.
+
+        Returns:
+            str: The JSON payload for the tool-call message."""
+        payload = json.dumps(
+            {
+                chunk_id: {"Title": result.title, "Chunk": result.chunk}
+                for chunk_id, result in results.items()
+            }
+        )
+        self._results[payload] = results
+
+        if self.backend is not None:
+            self.backend.put_results(
+                self.session_id,
+                payload,
+                {
+                    chunk_id: {
+                        "Title": result.title,
+                        "Chunk": result.chunk,
+                        "RerankerScore": result.reranker_score,
+                    }
+                    for chunk_id, result in results.items()
+                },
+            )
+
+        return payload
+
+    def restore(self, payload: str, results: dict[str, SearchResult]) -> None:
+        """Register results against a payload serialized earlier, e.g. when replaying."""
+        self._results[payload] = results
+
+    async def load(self, payload: str) -> dict[str, SearchResult]:
+        """Get the structured results for a tool-call payload, reading results
+        registered by another worker from the session state backend.
+
+        Args:
+            payload (str): The tool-call result content.
+
+        Returns:
+            dict[str, SearchResult]: The results keyed by ChunkId.
+
+        Raises:
+            json.JSONDecodeError: If an unregistered payload is not valid JSON."""
+        if payload in self._results or self.backend is None:
+            return self.lookup(payload)
+
+        records = await self.backend.get_results(self.session_id, payload)
+        if records is not None:
+            self._results[payload] = {
+                chunk_id: SearchResult(
+                    chunk_id,
+                    record["Title"],
+                    record["Chunk"],
+                    record["RerankerScore"],
+                )
+                for chunk_id, record in records.items()
+            }
+
+        return self.lookup(payload)
+
+    def lookup(self, payload: str) -> dict[str, SearchResult]:
+        """Get the structured results for a tool-call payload.
+
+        Payloads that were not registered or loaded are parsed.
+
+        Args:
+            payload (str): The tool-call result content.
+
+        Returns:
+            dict[str, SearchResult]: The results keyed by ChunkId.
+
+        Raises:
+            json.JSONDecodeError: If an unregistered payload is not valid JSON."""
+        if payload in self._results:
+            return self._results[payload]
+
+        return {
+            chunk_id: SearchResult(
+                chunk_id, result["Title"], result["Chunk"], reranker_score=None
+            )
+            for chunk_id, result in json.loads(payload).items()
+        }
+
+    def clear(self) -> None:
+        self._results.clear()
+
+        if self.backend is not None:
+            self.backend.delete_session(self.session_id)
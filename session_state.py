@@ -0,0 +1,297 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from settings import load_environment
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+
+def payload_key(payload: str) -> str:
+    """Key a serialized tool output by its hash rather than its full text."""
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SessionState(ABC):
+    """Storage for the state a session needs beyond a single worker process.
+
+    Figures are stored once by content digest, and chunks reference them by
+    digest. Retrieval results are stored per session as plain records,
+    `{ChunkId: {"Title", "Chunk", "RerankerScore"}}`.
+
+    Writes return without waiting for the backend, so they can be made from
+    synchronous code on the event loop. Reads are awaited."""
+
+    # Whether other worker processes see this state
+    shared = False
+
+    @abstractmethod
+    def put_figure(self, digest: str, payload: bytes) -> None: ...
+
+    @abstractmethod
+    async def get_figure(self, digest: str) -> bytes | None: ...
+
+    @abstractmethod
+    def put_chunk_figures(self, chunk_id: str, figures: dict[str, str]) -> None:
+        """Reference the figures of a chunk, mapping FigureId to digest."""
+
+    @abstractmethod
+    async def get_chunk_figures(self, chunk_id: str) -> dict[str, str] | None: ...
+
+    @abstractmethod
+    def put_results(
+        self, session_id: str, payload: str, records: dict[str, dict]
+    ) -> None: ...
+
+    @abstractmethod
+    async def get_results(
+        self, session_id: str, payload: str
+    ) -> dict[str, dict] | None: ...
+
+    @abstractmethod
+    def delete_session(self, session_id: str) -> None:
+        """Drop the session's results. Figures are shared, so they are kept."""
+
+    def close(self) -> None:
+        pass
+
+
+class InMemorySessionState(SessionState):
+    """Session state held in this process, for a single worker."""
+
+    def __init__(self):
+        self.figures: dict[str, bytes] = {}
+        self.chunk_figures: dict[str, dict[str, str]] = {}
+        self.results: dict[str, dict[str, dict[str, dict]]] = {}
+
+    def put_figure(self, digest: str, payload: bytes) -> None:
+        self.figures.setdefault(digest, bytes(payload))
+
+    async def get_figure(self, digest: str) -> bytes | None:
+        return self.figures.get(digest)
+
+    def put_chunk_figures(self, chunk_id: str, figures: dict[str, str]) -> None:
+        self.chunk_figures.setdefault(chunk_id, {}).update(figures)
+
+    async def get_chunk_figures(self, chunk_id: str) -> dict[str, str] | None:
+        return self.chunk_figures.get(chunk_id)
+
+    def put_results(
+        self, session_id: str, payload: str, records: dict[str, dict]
+    ) -> None:
+        self.results.setdefault(session_id, {})[payload_key(payload)] = records
+
+    async def get_results(
+        self, session_id: str, payload: str
+    ) -> dict[str, dict] | None:
+        return self.results.get(session_id, {}).get(payload_key(payload))
+
+    def delete_session(self, session_id: str) -> None:
+        self.results.pop(session_id, None)
+
+
+class SqliteSessionState(SessionState):
+    """Session state in a SQLite database shared by the workers on a host.
+
+    The database runs in WAL mode so workers read while another writes. Every
+    statement runs on a single background thread, so the event loop never
+    waits on the disk or on another worker's lock, and statements run in the
+    order they were made.
+
+    Figures and chunk references not used for `ttl` seconds are pruned, as are
+    the results of sessions that ended without being closed.
+
+    Args:
+        path (str): The database file.
+        busy_timeout (float, optional): Seconds to wait on another worker's lock.
+            Defaults to SessionState__BusyTimeout, or 1.
+        ttl (float, optional): Seconds unused rows are kept. Defaults to
+            SessionState__Ttl, or a day.
+        prune_interval (float, optional): Seconds between prunes. Defaults to
+            SessionState__PruneInterval, or an hour.
+    """
+
+    shared = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS figures (
+            digest TEXT PRIMARY KEY,
+            payload BLOB NOT NULL,
+            used_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS chunk_figures (
+            chunk_id TEXT NOT NULL,
+            figure_id TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            used_at REAL NOT NULL,
+            PRIMARY KEY (chunk_id, figure_id)
+        );
+        CREATE INDEX IF NOT EXISTS chunk_figures_digest ON chunk_figures (digest);
+        CREATE TABLE IF NOT EXISTS results (
+            session_id TEXT NOT NULL,
+            payload_key TEXT NOT NULL,
+            records TEXT NOT NULL,
+            used_at REAL NOT NULL,
+            PRIMARY KEY (session_id, payload_key)
+        );
+    """
+
+    def __init__(
+        self,
+        path: str,
+        busy_timeout: float = None,
+        ttl: float = None,
+        prune_interval: float = None,
+    ):
+        if busy_timeout is None:
+            busy_timeout = float(os.environ.get("SessionState__BusyTimeout", 1))
+        if ttl is None:
+            ttl = float(os.environ.get("SessionState__Ttl", 24 * 3600))
+        if prune_interval is None:
+            prune_interval = float(os.environ.get("SessionState__PruneInterval", 3600))
+
+        self.path = path
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self.pruned_at = 0.0
+
+        # The connection is only used from this thread
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="session-state")
+
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, timeout=busy_timeout
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(self.SCHEMA)
+
+    def submit(self, function, *args) -> Future:
+        """Run a function on the database thread."""
+        return self._executor.submit(function, *args)
+
+    def write(self, function, *args) -> None:
+        """Run a write on the database thread without waiting for it."""
+        self.submit(function, *args).add_done_callback(self.log_failure)
+
+    @staticmethod
+    def log_failure(future: Future) -> None:
+        if future.exception() is not None:
+            logging.error("Unable to write session state", exc_info=future.exception())
+
+    async def read(self, function, *args):
+        """Run a read on the database thread and wait for its result."""
+        return await asyncio.wrap_future(self.submit(function, *args))
+
+    def execute(self, sql: str, parameters: tuple = ()) -> list[tuple]:
+        return self._connection.execute(sql, parameters).fetchall()
+
+    def put_figure(self, digest: str, payload: bytes) -> None:
+        self.write(self._put_figure, digest, bytes(payload), time.time())
+
+    def _put_figure(self, digest: str, payload: bytes, used_at: float) -> None:
+        self.execute(
+            "INSERT INTO figures (digest, payload, used_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (digest) DO UPDATE SET used_at = excluded.used_at",
+            (digest, payload, used_at),
+        )
+
+        if used_at - self.pruned_at > self.prune_interval:
+            self.prune(used_at)
+
+    async def get_figure(self, digest: str) -> bytes | None:
+        return await self.read(self._get_figure, digest)
+
+    def _get_figure(self, digest: str) -> bytes | None:
+        rows = self.execute("SELECT payload FROM figures WHERE digest = ?", (digest,))
+        if not rows:
+            return None
+
+        self.execute(
+            "UPDATE figures SET used_at = ? WHERE digest = ?", (time.time(), digest)
+        )
+        return rows[0][0]
+
+    def put_chunk_figures(self, chunk_id: str, figures: dict[str, str]) -> None:
+        used_at = time.time()
+        self.write(
+            self._connection.executemany,
+            "INSERT OR REPLACE INTO chunk_figures "
+            "(chunk_id, figure_id, digest, used_at) VALUES (?, ?, ?, ?)",
+            [
+                (chunk_id, figure_id, digest, used_at)
+                for figure_id, digest in figures.items()
+            ],
+        )
+
+    async def get_chunk_figures(self, chunk_id: str) -> dict[str, str] | None:
+        rows = await self.read(
+            self.execute,
+            "SELECT figure_id, digest FROM chunk_figures WHERE chunk_id = ?",
+            (chunk_id,),
+        )
+        return dict(rows) if rows else None
+
+    def put_results(
+        self, session_id: str, payload: str, records: dict[str, dict]
+    ) -> None:
+        self.write(
+            self.execute,
+            "INSERT OR REPLACE INTO results "
+            "(session_id, payload_key, records, used_at) VALUES (?, ?, ?, ?)",
+            (session_id, payload_key(payload), json.dumps(records), time.time()),
+        )
+
+    async def get_results(
+        self, session_id: str, payload: str
+    ) -> dict[str, dict] | None:
+        rows = await self.read(
+            self.execute,
+            "SELECT records FROM results WHERE session_id = ? AND payload_key = ?",
+            (session_id, payload_key(payload)),
+        )
+        return json.loads(rows[0][0]) if rows else None
+
+    def delete_session(self, session_id: str) -> None:
+        self.write(
+            self.execute, "DELETE FROM results WHERE session_id = ?", (session_id,)
+        )
+
+    def prune(self, now: float) -> None:
+        """Delete the rows unused for the TTL. Runs on the database thread."""
+        cutoff = now - self.ttl
+        self.pruned_at = now
+
+        self.execute("DELETE FROM results WHERE used_at < ?", (cutoff,))
+        self.execute("DELETE FROM chunk_figures WHERE used_at < ?", (cutoff,))
+        # A figure still referenced by a chunk may be read through it
+        self.execute(
+            "DELETE FROM figures WHERE used_at < ? AND NOT EXISTS "
+            "(SELECT 1 FROM chunk_figures WHERE chunk_figures.digest = figures.digest)",
+            (cutoff,),
+        )
+
+    def close(self) -> None:
+        self._executor.submit(self._connection.close)
+        self._executor.shutdown(wait=True)
+
+
+def load_session_state() -> SessionState:
+    """Create the backend configured by SessionState__Backend: memory or sqlite."""
+    backend = os.environ.get("SessionState__Backend", "memory").lower()
+
+    if backend == "memory":
+        return InMemorySessionState()
+
+    if backend == "sqlite":
+        return SqliteSessionState(
+            os.environ.get("SessionState__Path", "session_state.db")
+        )
+
+    raise ValueError(f"Unknown session state backend {backend}")
+
+
+load_environment()
+SESSION_STATE = load_session_state()
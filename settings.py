@@ -0,0 +1,8 @@
+from dotenv import load_dotenv, find_dotenv
+from functools import cache
+
+
+@cache
+def load_environment() -> None:
+    """Load the .env file into the environment. Only the first call does any work."""
+    load_dotenv(find_dotenv())
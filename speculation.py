@@ -0,0 +1,144 @@
+from autogen_agentchat.messages import (
+    ToolCallRequestEvent,
+    ToolCallSummaryMessage,
+    TextMessage,
+)
+from autogen_core.models import ChatCompletionClient, SystemMessage, UserMessage
+from typing import Callable
+from preview import chunk_preview
+from settings import load_environment
+from tools import SearchTool
+import asyncio
+import json
+import logging
+import os
+import re
+
+SPECULATIVE_SYSTEM_MESSAGE = "You are a senior research agent specialising in company based research for a financial services company. Given the user's question, the search terms already used and the results they found, formulate new search terms that would retrieve additional information missing from the results. Reply with one search term per line and nothing else."
+
+
+class SpeculativeResearch:
+    """Drafts and prefetches the revise-research searches while the first answer streams.
+
+    Once the breadth first results are in, the mini model drafts the follow-up
+    search terms and the search tool starts fetching them. The revise research
+    agent's real tool call claims the prefetches that match its terms, and the
+    rest are discarded."""
+
+    def __init__(
+        self,
+        search_tool: SearchTool,
+        model_client: Callable[[], ChatCompletionClient],
+        enabled: bool = None,
+        max_terms: int = None,
+    ):
+        load_environment()
+
+        if enabled is None:
+            enabled = (
+                os.environ.get("SpeculativeResearch__Enabled", "false").lower()
+                == "true"
+            )
+        if max_terms is None:
+            max_terms = int(os.environ.get("SpeculativeResearch__MaxTerms", 5))
+
+        self.search_tool = search_tool
+        self.model_client = model_client
+        self.enabled = enabled
+        self.max_terms = max_terms
+
+        self._task: asyncio.Task | None = None
+
+    def build_prompt(self, messages) -> str:
+        """Summarise the question and breadth first research for the draft."""
+        question = ""
+        search_terms = []
+        results = []
+
+        for message in messages:
+            if isinstance(message, TextMessage) and message.source == "user":
+                question = message.content
+            elif isinstance(message, ToolCallRequestEvent):
+                for call in message.content:
+                    try:
+                        search_terms.extend(
+                            json.loads(call.arguments).get("search_terms", [])
+                        )
+                    except json.JSONDecodeError:
+                        continue
+            elif isinstance(message, ToolCallSummaryMessage):
+                try:
+                    found = self.search_tool.search_results.lookup(message.content)
+                except json.JSONDecodeError:
+                    continue
+
+                results.extend(
+                    f"- {result.title}: {chunk_preview(chunk_id, result.chunk)}"
+                    for chunk_id, result in found.items()
+                )
+
+        return "\n".join(
+            [
+                f"Question: {question}",
+                "Search terms used: " + "; ".join(search_terms),
+                "Results found:",
+                *results,
+                f"Write {self.max_terms} new search terms.",
+            ]
+        )
+
+    @staticmethod
+    def parse_terms(content: str) -> list[str]:
+        """Split the model's reply into search terms, dropping list markers."""
+        terms = []
+        for line in content.splitlines():
+            term = re.sub(r"^\s*(?:[-*]|\d+[.)])\s*", "", line).strip().strip('"')
+            if term:
+                terms.append(term)
+
+        return terms
+
+    async def prefetch(self, prompt: str) -> None:
+        result = await self.model_client().create(
+            [
+                SystemMessage(content=SPECULATIVE_SYSTEM_MESSAGE),
+                UserMessage(content=prompt, source="user"),
+            ]
+        )
+        if not isinstance(result.content, str):
+            return
+
+        terms = self.parse_terms(result.content)[: self.max_terms]
+        logging.info("Speculatively searching for %s", terms)
+
+        self.search_tool.speculate_depth_first(terms)
+
+    def start(self, messages) -> None:
+        """Start drafting the follow-up searches in the background.
+
+        Args:
+            messages: The group chat's message thread after the breadth first search.
+        """
+        if not self.enabled or self._task is not None:
+            return
+
+        self._task = asyncio.create_task(self.prefetch(self.build_prompt(messages)))
+        self._task.add_done_callback(self.log_failure)
+
+    @staticmethod
+    def log_failure(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning("Speculative research failed: %s", task.exception())
+
+    def stop_drafting(self) -> None:
+        """Stop a draft that has not finished, as it can no longer save time.
+
+        Searches already started from a finished draft carry on."""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    def cancel(self) -> None:
+        """Cancel the draft and drop every prefetch, ready for a new turn."""
+        self.stop_drafting()
+        self._task = None
+        self.search_tool.discard_speculation()
@@ -0,0 +1,93 @@
+import asyncio
+import chainlit as cl
+import os
+import re
+import time
+
+# A token ending a sentence, or a line
+SENTENCE_END = re.compile(r"[.!?:;]\s*$|\n")
+
+
+class CoalescingStreamer:
+    """Streams tokens to a Chainlit message in batches rather than one by one.
+
+    Each `stream_token` is a websocket frame and an event loop round trip, so
+    tokens are buffered and sent together once `max_tokens` have been buffered,
+    the oldest has waited `max_delay` seconds, or a sentence ends. A timer
+    flushes the buffer if the model stalls mid sentence.
+
+    Args:
+        message (cl.Message): The message being streamed.
+        max_tokens (int, optional): Tokens to buffer before flushing. Defaults to
+            Streaming__MaxTokens, or 16.
+        max_delay (float, optional): Seconds a token may wait before flushing.
+            Defaults to Streaming__MaxDelay, or 0.03.
+    """
+
+    def __init__(
+        self, message: cl.Message, max_tokens: int = None, max_delay: float = None
+    ):
+        if max_tokens is None:
+            max_tokens = int(os.environ.get("Streaming__MaxTokens", 16))
+        if max_delay is None:
+            max_delay = float(os.environ.get("Streaming__MaxDelay", 0.03))
+
+        self.message = message
+        self.max_tokens = max_tokens
+        self.max_delay = max_delay
+
+        self.buffer: list[str] = []
+        self.buffered_at = 0.0
+        self.tokens = 0
+        self.frames = 0
+
+        self._lock = asyncio.Lock()
+        self._timer: asyncio.TimerHandle | None = None
+        self._timed_flush: asyncio.Task | None = None
+
+    async def stream_token(self, token: str) -> None:
+        """Buffer a token, flushing if a threshold is reached."""
+        if not self.buffer:
+            self.buffered_at = time.perf_counter()
+            self._timer = asyncio.get_running_loop().call_later(
+                self.max_delay, self._flush_later
+            )
+
+        self.buffer.append(token)
+        self.tokens += 1
+
+        if (
+            len(self.buffer) >= self.max_tokens
+            or time.perf_counter() - self.buffered_at >= self.max_delay
+            or SENTENCE_END.search(token)
+        ):
+            await self.flush()
+
+    def _flush_later(self) -> None:
+        self._timer = None
+        self._timed_flush = asyncio.create_task(self.flush())
+
+    async def flush(self) -> None:
+        """Send the buffered tokens as a single frame."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        # Frames must go out in order, so a timed flush and an inline one queue up
+        async with self._lock:
+            if not self.buffer:
+                return
+
+            content = "".join(self.buffer)
+            self.buffer.clear()
+
+            await self.message.stream_token(content)
+            self.frames += 1
+
+    async def close(self) -> None:
+        """Flush what is left and stop the timer."""
+        await self.flush()
+
+        if self._timed_flush is not None:
+            await self._timed_flush
+            self._timed_flush = None
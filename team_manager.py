@@ -0,0 +1,72 @@
+from rag import Rag
+from rat import Rat
+from session_state import SESSION_STATE, SessionState
+import logging
+
+
+class TeamManager:
+    """Session scoped holder for the RAG and RAT teams.
+
+    Each team is built the first time it is selected and reused for every
+    following turn, being reset between turns rather than rebuilt.
+
+    Args:
+        session_id (str, optional): The chat session, to store the teams' results
+            under in the session state backend.
+        state (SessionState, optional): The session state backend.
+    """
+
+    team_classes = {"RAG Agent": Rag, "RAT Agent": Rat}
+
+    def __init__(self, session_id: str = None, state: SessionState = SESSION_STATE):
+        self.session_id = session_id
+        self.state = state
+        self.teams: dict[str, Rag | Rat] = {}
+
+    def get(self, agent: str) -> Rag | Rat | None:
+        """Get the team for the agent choice, building it on first use.
+
+        Args:
+            agent (str): The agent choice from the chat settings.
+
+        Returns:
+            Rag | Rat | None: The team, or None if the choice is unknown."""
+        if agent not in self.team_classes:
+            return None
+
+        if agent not in self.teams:
+            self.teams[agent] = self.team_classes[agent](session_id=self.session_id)
+
+        return self.teams[agent]
+
+    async def team_for_turn(self, agent: str) -> Rag | Rat | None:
+        """Get the team for the agent choice, reset ready for a new turn.
+
+        A team whose previous run did not shut down cleanly cannot be reset, so
+        it is thrown away and a new one built in its place."""
+        team = self.get(agent)
+        if team is None:
+            return None
+
+        try:
+            await team.reset()
+        except RuntimeError:
+            logging.warning(
+                "Unable to reset the %s team, rebuilding it", agent, exc_info=True
+            )
+            team.search_tool.cancel_prewarm()
+            del self.teams[agent]
+            team = self.get(agent)
+
+        return team
+
+    def select(self, agent: str) -> None:
+        """Build the team for a newly selected agent choice ahead of its first turn.
+
+        The team for the other choice is left untouched."""
+        self.get(agent)
+
+    def close(self) -> None:
+        """Drop the session's results from the backend."""
+        if self.session_id is not None:
+            self.state.delete_session(self.session_id)
@@ -1,94 +1,498 @@
 from autogen_core.tools import FunctionTool
 from azure.search.documents.models import QueryType, VectorizableTextQuery
-from azure.search.documents import SearchClient
-from azure.core.credentials import AzureKeyCredential
+from search_client_pool import SEARCH_CLIENT_POOL, SearchClientPool
+from search_cache import SEARCH_RESULT_CACHE, SearchResultCache
+from figure_store import FigureStore
+from search_results import SearchResult, SearchResultRegistry
+from tracing import TRACER
+from local_index import LOCAL_INDEX, LocalIndex
+from chunk_deduplication import SeenChunkIndex
+from query_planning import QUERY_PLANNER, QueryPlanner, term_signature
+from retrieval_planning import RETRIEVAL_PLANNER, RetrievalPlanner
+from prewarm import WarmSearch
 import os
+import asyncio
 import logging
-from dotenv import load_dotenv, find_dotenv
-import json
-import base64
-
-load_dotenv(find_dotenv())
 
 
 class SearchTool:
-    def __init__(self, figure_and_chunk_pairs: dict):
+    semantic_configuration_name = "image-processing-semantic-config"
+
+    def __init__(
+        self,
+        figure_and_chunk_pairs: FigureStore,
+        max_concurrency: int = None,
+        client_pool: SearchClientPool = SEARCH_CLIENT_POOL,
+        cache: SearchResultCache = SEARCH_RESULT_CACHE,
+        search_results: SearchResultRegistry = None,
+        seen_chunks: SeenChunkIndex = None,
+        novelty_overfetch: int = None,
+        query_planner: QueryPlanner = QUERY_PLANNER,
+        local_index: LocalIndex | None = LOCAL_INDEX,
+        retrieval_planner: RetrievalPlanner = RETRIEVAL_PLANNER,
+    ):
         self.figure_and_chunk_pairs = figure_and_chunk_pairs
+        self.search_results = (
+            search_results if search_results is not None else SearchResultRegistry()
+        )
+        self.seen_chunks = seen_chunks if seen_chunks is not None else SeenChunkIndex()
+        self.query_planner = query_planner
+        self.local_index = local_index
+        self.retrieval_planner = retrieval_planner
+        self.client_pool = client_pool
+        self.cache = cache
 
-    def search_index(self, queries: list[str], top) -> list[dict]:
+        if max_concurrency is None:
+            max_concurrency = int(
+                os.environ.get("AIService__AzureSearchOptions__MaxConcurrency", 5)
+            )
+        self.max_concurrency = max_concurrency
+        # Shared by the tool calls and speculative searches of the conversation
+        self.semaphore = asyncio.Semaphore(max_concurrency)
 
-        final_results = {}
+        if novelty_overfetch is None:
+            novelty_overfetch = int(
+                os.environ.get("AIService__AzureSearchOptions__NoveltyOverfetch", 2)
+            )
+        self.novelty_overfetch = novelty_overfetch
 
-        for query in queries:
-            vector_query = [
-                VectorizableTextQuery(
-                    text=query,
-                    k_nearest_neighbors=top * 5,
-                    fields="ChunkEmbedding",
-                )
-            ]
+        # Speculative queries: (term signature, top, task)
+        self.speculative: list[tuple[frozenset[str], int, asyncio.Task]] = []
+        self.speculative_hits = 0
+
+        # Searches made by the tool calls of the current turn
+        self.searches: list[WarmSearch] = []
+        # Searches prefetched on a guess in the current turn, kept apart as they
+        # may be discarded
+        self.speculative_searches: list[WarmSearch] = []
+        # Background searches started when the session opened, by cache key
+        self.prewarming: dict[tuple, asyncio.Task] = {}
 
-            credential = AzureKeyCredential(
-                os.environ["AIService__AzureSearchOptions__Key"]
+    @property
+    def reranker_threshold(self) -> float:
+        return self.retrieval_planner.threshold
+
+    def cache_key(self, query: str, top: int) -> tuple:
+        return self.cache.make_key(
+            query, top, self.semantic_configuration_name, self.client_pool.index_name
+        )
+
+    def to_record(self, result: dict) -> dict:
+        """Convert a raw index result into the record stored in the cache."""
+        # Keep the base64 payloads, they are only decoded if a figure is displayed
+        figures = {
+            figure["FigureId"]: self.figure_and_chunk_pairs.put(figure["Data"])
+            for figure in result["ChunkFigures"]
+        }
+
+        return {
+            "ChunkId": result["ChunkId"],
+            "Title": result["Title"],
+            "Chunk": result["Chunk"],
+            "RerankerScore": result["@search.reranker_score"],
+            "Figures": figures,
+        }
+
+    async def search_page(
+        self,
+        query: str,
+        top: int,
+        skip: int,
+        knn: int,
+        semaphore: asyncio.Semaphore,
+    ) -> list[dict]:
+        """Fetch one page of raw results from the Azure Search index."""
+        vector_query = [
+            VectorizableTextQuery(
+                text=query,
+                k_nearest_neighbors=knn,
+                fields="ChunkEmbedding",
             )
-            retrieval_fields = ["ChunkId", "Title", "Chunk", "ChunkFigures"]
-            with SearchClient(
-                endpoint=os.environ["AIService__AzureSearchOptions__Endpoint"],
-                index_name="image-processing-index",
-                credential=credential,
-            ) as search_client:
-
-                results = list(
-                    search_client.search(
+        ]
+
+        retrieval_fields = ["ChunkId", "Title", "Chunk", "ChunkFigures"]
+
+        async with semaphore:
+            with TRACER.span("search.page", top=top, skip=skip, knn=knn) as span:
+                async with self.client_pool.acquire() as search_client:
+                    results = await search_client.search(
                         top=top,
-                        semantic_configuration_name="image-processing-semantic-config",
+                        skip=skip,
+                        semantic_configuration_name=self.semantic_configuration_name,
                         search_text=query,
                         select=",".join(retrieval_fields),
                         vector_queries=vector_query,
                         query_type=QueryType.SEMANTIC,
                         query_language="en-GB",
                     )
+
+                    results = [result async for result in results]
+
+                span.set(results=len(results))
+
+        return results
+
+    async def fetch(
+        self,
+        query: str,
+        top: int,
+        semaphore: asyncio.Semaphore,
+        mode: str = "rag",
+    ) -> list[dict]:
+        """Run a single query against the Azure Search index.
+
+        The retrieval planner sizes the first page from the scores seen so far for
+        the tool mode. The rest of the results are only requested once that page
+        has come back and scored well, so a query that does not widen costs a
+        single semantic-ranked request.
+
+        Args:
+            query (str): The search term to run.
+            top (int): The number of results to return.
+            semaphore (asyncio.Semaphore): Caps the number of in-flight queries.
+            mode (str, optional): The tool mode, e.g. "rag". Defaults to "rag".
+
+        Returns:
+            list[dict]: The records that passed the reranker threshold."""
+        plan = self.retrieval_planner.plan(mode, top)
+
+        results = await self.search_page(query, plan.page_top, 0, plan.knn, semaphore)
+        scores = [result["@search.reranker_score"] for result in results]
+
+        if self.retrieval_planner.should_widen(plan, scores):
+            more = await self.search_page(
+                query, plan.top - plan.page_top, plan.page_top, plan.knn, semaphore
+            )
+            results += more
+            scores += [result["@search.reranker_score"] for result in more]
+
+        self.retrieval_planner.observe(mode, scores)
+
+        logging.debug("Search for %s returned %d results", query, len(results))
+
+        return [
+            self.to_record(result)
+            for result, score in zip(results, scores)
+            if score >= self.reranker_threshold
+        ]
+
+    async def fetch_local(self, query: str, top: int) -> list[dict] | None:
+        """Run a single query against the local index replica.
+
+        Args:
+            query (str): The search term to run.
+            top (int): The number of results to return.
+
+        Returns:
+            list[dict] | None: The records that passed the reranker threshold, or
+                None if the local results are not confident enough to use."""
+        results = await self.local_index.search(query, top)
+        if results is None:
+            return None
+
+        return [
+            self.to_record(result)
+            for result in results
+            if result["@search.reranker_score"] >= self.reranker_threshold
+        ]
+
+    async def run_query(
+        self,
+        query: str,
+        top: int,
+        semaphore: asyncio.Semaphore,
+        mode: str = "rag",
+    ) -> list[dict]:
+        """Run a single query, serving it from the cache or a speculative prefetch if possible.
+
+        Args:
+            query (str): The search term to run.
+            top (int): The number of results to return.
+            semaphore (asyncio.Semaphore): Caps the number of in-flight queries.
+            mode (str, optional): The tool mode, e.g. "rag". Defaults to "rag".
+
+        Returns:
+            list[dict]: The records that passed the reranker threshold."""
+        with TRACER.span("search.query", top=top, mode=mode) as span:
+            cache_key = self.cache_key(query, top)
+            records = self.cache.get(cache_key)
+
+            if records is None and self.local_index is not None:
+                records = await self.fetch_local(query, top)
+
+                if records is not None:
+                    span.set(source="local")
+                    self.cache.set(cache_key, records)
+            elif records is not None:
+                span.set(source="cache")
+
+            if records is None:
+                records = await self.take_prewarmed(cache_key)
+
+                if records is not None:
+                    span.set(source="prewarm")
+                    span.set(results=len(records), bytes=self.cache.size_of(records))
+                    return records
+
+                records = await self.take_speculative(query, top)
+
+                if records is not None:
+                    # Fetched for a near duplicate term, so cached under that term
+                    span.set(source="speculative")
+                else:
+                    span.set(source="index")
+                    records = await self.fetch(query, top, semaphore, mode)
+                    self.cache.set(cache_key, records)
+
+            span.set(results=len(records), bytes=self.cache.size_of(records))
+
+        return records
+
+    def speculate(
+        self, queries: list[str], top: int, exclude_seen: bool, mode: str
+    ) -> None:
+        """Start fetching queries that a later search is expected to make.
+
+        Args:
+            queries (list[str]): The predicted search terms.
+            top (int): The number of results the later search keeps per query.
+            exclude_seen (bool): Whether the later search excludes seen chunks.
+            mode (str): The tool mode of the later search."""
+        fetch_top = top * self.novelty_overfetch if exclude_seen else top
+        self.speculative_searches.extend(
+            WarmSearch(query, fetch_top, mode) for query in queries
+        )
+
+        for query in queries:
+            if self.cache_key(query, fetch_top) in self.cache:
+                continue
+
+            self.speculative.append(
+                (
+                    term_signature(query),
+                    fetch_top,
+                    asyncio.create_task(self.fetch_speculative(query, fetch_top, mode)),
                 )
+            )
+
+    async def fetch_speculative(self, query: str, top: int, mode: str) -> list[dict]:
+        """Run a speculative query, caching the records under its own term."""
+        records = await self.fetch(query, top, self.semaphore, mode)
+        self.cache.set(self.cache_key(query, top), records)
+
+        return records
+
+    async def take_speculative(self, query: str, top: int) -> list[dict] | None:
+        """Claim a speculative prefetch matching the query, if there is one.
+
+        A prefetch matches if its term is a near duplicate of the query, as judged
+        by the query planner, and it fetched at least as many results."""
+        signature = term_signature(query)
+
+        for index, (speculative_signature, speculative_top, task) in enumerate(
+            self.speculative
+        ):
+            is_match = (
+                speculative_top >= top
+                and self.query_planner.similarity(signature, speculative_signature)
+                >= self.query_planner.similarity_threshold
+            )
+            if not is_match or task.cancelled():
+                continue
+
+            del self.speculative[index]
+
+            try:
+                records = await task
+            except Exception:
+                logging.exception("Speculative search for %s failed", query)
+                return None
+
+            self.speculative_hits += 1
+            return records[:top]
 
-                for result in results:
-                    if (
-                        result["ChunkId"] not in final_results
-                        and result["@search.reranker_score"] >= 2.5
-                    ):
-                        chunk_to_store = {
-                            "Title": result["Title"],
-                            "Chunk": result["Chunk"],
-                        }
-                        final_results[result["ChunkId"]] = chunk_to_store
+        return None
+
+    def discard_speculation(self) -> None:
+        """Cancel and drop the speculative prefetches that were not used."""
+        if self.speculative or self.speculative_hits:
+            logging.info(
+                "Used %d speculative searches, discarded %d",
+                self.speculative_hits,
+                len(self.speculative),
+            )
+
+        for _, _, task in self.speculative:
+            task.cancel()
+
+        self.speculative.clear()
+        self.speculative_hits = 0
+
+    def prewarm(self, searches: list[WarmSearch], semaphore: asyncio.Semaphore) -> None:
+        """Start running searches in the background ahead of the first question.
+
+        The results go into the shared search cache with their figures decoded. A
+        query made while its prewarm is in flight waits for it instead of
+        searching again.
+
+        Args:
+            searches (list[WarmSearch]): The searches to run.
+            semaphore (asyncio.Semaphore): Caps the prewarm searches in flight across
+                every session."""
+        for search in searches:
+            cache_key = self.cache_key(search.query, search.top)
+            if cache_key in self.cache or cache_key in self.prewarming:
+                continue
+
+            task = asyncio.create_task(self.warm(search, semaphore))
+            task.add_done_callback(
+                lambda _, cache_key=cache_key: self.prewarming.pop(cache_key, None)
+            )
+            self.prewarming[cache_key] = task
+
+    async def warm(
+        self, search: WarmSearch, semaphore: asyncio.Semaphore
+    ) -> list[dict]:
+        """Run a prewarm search, caching the records and decoding their figures."""
+        with TRACER.span("search.prewarm", top=search.top, mode=search.mode) as span:
+            records = None
+            if self.local_index is not None:
+                records = await self.fetch_local(search.query, search.top)
+
+            if records is None:
+                records = await self.fetch(
+                    search.query, search.top, semaphore, search.mode
+                )
 
-                        if result["ChunkId"] not in self.figure_and_chunk_pairs:
-                            self.figure_and_chunk_pairs[result["ChunkId"]] = {}
+            self.cache.set(self.cache_key(search.query, search.top), records)
 
-                        # Store the figures for later
-                        for figure in result["ChunkFigures"]:
-                            for figure in result["ChunkFigures"]:
-                                # Convert the base64 image to a bytes object.
-                                image_data = base64.b64decode(figure["Data"])
+            for record in records:
+                for figure in record["Figures"].values():
+                    await self.figure_and_chunk_pairs.decode(figure.digest)
 
-                                self.figure_and_chunk_pairs[result["ChunkId"]][
-                                    figure["FigureId"]
-                                ] = image_data
+            span.set(results=len(records))
 
-                logging.info("Results: %s", results)
+        return records
 
-        return json.dumps(final_results)
+    async def take_prewarmed(self, cache_key: tuple) -> list[dict] | None:
+        """Wait for the prewarm of the query, if one is in flight."""
+        task = self.prewarming.pop(cache_key, None)
+        if task is None or task.cancelled():
+            return None
 
-    def rag_search_index(self, search_term: str) -> list[dict]:
+        try:
+            return await task
+        except Exception:
+            logging.exception("Prewarm search for %s failed", cache_key[0])
+            return None
+
+    def cancel_prewarm(self) -> None:
+        """Cancel the prewarm searches still in flight."""
+        for task in self.prewarming.values():
+            task.cancel()
+
+        self.prewarming.clear()
+
+    async def search_index(
+        self,
+        queries: list[str],
+        top: int,
+        exclude_seen: bool = False,
+        mode: str = "rag",
+    ) -> str:
+        """Search the index for each query and merge the results.
+
+        Args:
+            queries (list[str]): The search terms to run.
+            top (int): The number of results to keep per query.
+            exclude_seen (bool, optional): Drop chunks, and near duplicates of chunks,
+                already returned in this conversation, fetching extra candidates to
+                fill the freed slots. Defaults to False.
+            mode (str, optional): The tool mode, used to plan retrieval depth.
+                Defaults to "rag".
+
+        Returns:
+            str: The serialized results."""
+        plan = self.query_planner.plan(queries, top)
+        if plan.collapsed:
+            logging.info(
+                "Collapsed %d near-duplicate search terms, fetching top %d for %s",
+                plan.collapsed,
+                plan.top,
+                plan.queries,
+            )
+        queries, top = plan.queries, plan.top
+
+        fetch_top = top * self.novelty_overfetch if exclude_seen else top
+        self.searches.extend(WarmSearch(query, fetch_top, mode) for query in queries)
+
+        # Fan the queries out concurrently, gather keeps the results in query order
+        query_records = await asyncio.gather(
+            *[
+                self.run_query(query, fetch_top, self.semaphore, mode)
+                for query in queries
+            ]
+        )
+
+        final_results = {}
+        suppressed = 0
+
+        for records in query_records:
+            kept = 0
+            for record in records:
+                if kept >= top:
+                    break
+
+                if record["ChunkId"] in final_results:
+                    continue
+
+                if exclude_seen and self.seen_chunks.is_seen(
+                    record["ChunkId"], record["Chunk"]
+                ):
+                    suppressed += 1
+                    continue
+
+                final_results[record["ChunkId"]] = SearchResult(
+                    record["ChunkId"],
+                    record["Title"],
+                    record["Chunk"],
+                    record["RerankerScore"],
+                )
+                self.seen_chunks.add(record["ChunkId"], record["Chunk"])
+                kept += 1
+
+                # Store the figures for later
+                self.figure_and_chunk_pairs.add_figures(
+                    record["ChunkId"], record["Figures"]
+                )
+
+        if suppressed:
+            logging.info("Suppressed %d previously seen chunks", suppressed)
+
+        # Serialized once for the tool-call message, the UI and answer agents read
+        # the structured results from the registry
+        return self.search_results.register(final_results)
+
+    async def rag_search_index(self, search_term: str) -> str:
         """Search the Azure Search index for the given query."""
-        return self.search_index([search_term], top=4)
+        return await self.search_index([search_term], top=4, mode="rag")
 
-    def rat_search_index_breadth_first(self, search_terms: list[str]) -> list[dict]:
+    async def rat_search_index_breadth_first(self, search_terms: list[str]) -> str:
         """Search the Azure Search index for the given set of queries."""
-        return self.search_index(search_terms, top=1)
+        return await self.search_index(search_terms, top=1, mode="breadth_first")
 
-    def rat_search_index_depth_first(self, search_terms: list[str]) -> list[dict]:
+    async def rat_search_index_depth_first(self, search_terms: list[str]) -> str:
         """Search the Azure Search index for the given set of queries."""
-        return self.search_index(search_terms, top=3)
+        try:
+            return await self.search_index(
+                search_terms, top=3, exclude_seen=True, mode="depth_first"
+            )
+        finally:
+            self.discard_speculation()
+
+    def speculate_depth_first(self, search_terms: list[str]) -> None:
+        """Prefetch the searches a later depth first call is expected to make."""
+        self.speculate(search_terms, top=3, exclude_seen=True, mode="depth_first")
 
     @property
     def rat_breadth_first_tool(self):
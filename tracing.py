@@ -0,0 +1,228 @@
+from settings import load_environment
+from typing import TextIO
+import json
+import logging
+import os
+import time
+
+# Upper bounds, in seconds, of the Prometheus latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def escape_label(value) -> str:
+    """Escape a Prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Span:
+    """A timed operation. String attributes label the span, numeric ones are summed."""
+
+    __slots__ = ("tracer", "name", "attributes", "started_at", "started", "duration")
+
+    def __init__(self, tracer: "Tracer", name: str, attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.started_at = 0.0
+        self.started = 0.0
+        self.duration = 0.0
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> "Span":
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.duration = time.perf_counter() - self.started
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+
+        self.tracer.finish(self)
+
+
+class NoOpSpan:
+    """Stands in for a span when tracing is disabled."""
+
+    __slots__ = ()
+
+    def set(self, **attributes) -> None:
+        pass
+
+    def __enter__(self) -> "NoOpSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        pass
+
+
+NO_OP_SPAN = NoOpSpan()
+
+
+class SpanStats:
+    """Aggregated timings and attribute totals for one span name and label set."""
+
+    __slots__ = ("count", "seconds", "buckets", "totals")
+
+    def __init__(self, buckets: int):
+        self.count = 0
+        self.seconds = 0.0
+        self.buckets = [0] * buckets
+        self.totals: dict[str, float] = {}
+
+
+class Tracer:
+    """Records spans for the stages of a turn and exports them.
+
+    Finished spans are appended to a JSON lines file and/or aggregated into
+    Prometheus histograms. When tracing is disabled `span` hands out a shared
+    no-op span, so instrumented code pays for little more than the call."""
+
+    def __init__(
+        self,
+        enabled: bool = None,
+        file_path: str = None,
+        prometheus: bool = None,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        if enabled is None:
+            enabled = os.environ.get("Tracing__Enabled", "false").lower() == "true"
+        if file_path is None:
+            file_path = os.environ.get("Tracing__File")
+        if prometheus is None:
+            prometheus = os.environ.get("Tracing__Prometheus", "true").lower() == "true"
+
+        self.enabled = enabled
+        self.file_path = file_path
+        self.prometheus = enabled and prometheus
+        self.bucket_bounds = buckets
+
+        self._file: TextIO | None = None
+        self._stats: dict[tuple, SpanStats] = {}
+
+    def span(self, name: str, **attributes) -> Span | NoOpSpan:
+        """Start a span, for use as a context manager.
+
+        Args:
+            name (str): The span name, e.g. "search.query".
+            **attributes: Labels (strings) and counts or sizes (numbers).
+
+        Returns:
+            Span | NoOpSpan: The span."""
+        if not self.enabled:
+            return NO_OP_SPAN
+
+        return Span(self, name, attributes)
+
+    def record(self, name: str, duration: float, **attributes) -> None:
+        """Record a span that was timed elsewhere."""
+        if not self.enabled:
+            return
+
+        span = Span(self, name, attributes)
+        span.started_at = time.time() - duration
+        span.duration = duration
+        self.finish(span)
+
+    def finish(self, span: Span) -> None:
+        if self.file_path is not None:
+            self.write(span)
+
+        if self.prometheus:
+            self.aggregate(span)
+
+    def write(self, span: Span) -> None:
+        if self._file is None:
+            self._file = open(self.file_path, "a", buffering=1)
+
+        try:
+            self._file.write(
+                json.dumps(
+                    {
+                        "span": span.name,
+                        "start": span.started_at,
+                        "duration": span.duration,
+                        **span.attributes,
+                    },
+                    default=str,
+                )
+                + "\n"
+            )
+        except OSError:
+            logging.exception("Unable to write span to %s", self.file_path)
+
+    def aggregate(self, span: Span) -> None:
+        labels = tuple(
+            sorted(
+                (key, value)
+                for key, value in span.attributes.items()
+                if isinstance(value, str)
+            )
+        )
+
+        key = (span.name, labels)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = SpanStats(len(self.bucket_bounds))
+
+        stats.count += 1
+        stats.seconds += span.duration
+
+        for index, bound in enumerate(self.bucket_bounds):
+            if span.duration <= bound:
+                stats.buckets[index] += 1
+                break
+
+        for attribute, value in span.attributes.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                stats.totals[attribute] = stats.totals.get(attribute, 0) + value
+
+    @staticmethod
+    def format_labels(labels: tuple, **extra) -> str:
+        return ",".join(
+            f'{key}="{escape_label(value)}"' for key, value in [*labels, *extra.items()]
+        )
+
+    def prometheus_text(self) -> str:
+        """Render the aggregated spans in the Prometheus text exposition format."""
+        lines = [
+            "# HELP span_seconds Duration of traced operations.",
+            "# TYPE span_seconds histogram",
+        ]
+
+        for (name, labels), stats in self._stats.items():
+            cumulative = 0
+            for bound, count in zip(self.bucket_bounds, stats.buckets):
+                cumulative += count
+                bucket_labels = self.format_labels(labels, span=name, le=bound)
+                lines.append(f"span_seconds_bucket{{{bucket_labels}}} {cumulative}")
+
+            bucket_labels = self.format_labels(labels, span=name, le="+Inf")
+            lines.append(f"span_seconds_bucket{{{bucket_labels}}} {stats.count}")
+
+            label_text = self.format_labels(labels, span=name)
+            lines.append(f"span_seconds_sum{{{label_text}}} {stats.seconds}")
+            lines.append(f"span_seconds_count{{{label_text}}} {stats.count}")
+
+        lines.append("# HELP span_attribute_total Counts and sizes recorded on spans.")
+        lines.append("# TYPE span_attribute_total counter")
+
+        for (name, labels), stats in self._stats.items():
+            for attribute, total in stats.totals.items():
+                attribute_labels = self.format_labels(
+                    labels, span=name, attribute=attribute
+                )
+                lines.append(f"span_attribute_total{{{attribute_labels}}} {total}")
+
+        return "\n".join(lines) + "\n"
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+load_environment()
+TRACER = Tracer()
@@ -5,11 +5,23 @@ from autogen_agentchat.base import Response
 from autogen_agentchat.messages import AgentEvent, ChatMessage, MultiModalMessage
 from autogen_core import CancellationToken
 import json
-from autogen_core import Image
 from autogen_agentchat.messages import ToolCallExecutionEvent
 from figure_processing import get_figures_from_chunk
+from figure_store import FigureStore
+from search_results import SearchResultRegistry
+from context_packing import (
+    CONTEXT_PACKER,
+    ChunkCandidate,
+    ContextPacker,
+    PackedChunk,
+    PackingReport,
+    token_budget,
+)
+from image_preprocessing import FIGURE_PREPROCESSOR, FigurePreprocessor
 
 import logging
+
+
 class VisualAgent(AssistantAgent):
     def __init__(
         self,
@@ -18,7 +30,12 @@ class VisualAgent(AssistantAgent):
         system_message: str,
         model_client,
         model_client_stream,
-        chunk_and_figure_pairs: dict,
+        chunk_and_figure_pairs: FigureStore,
+        search_results: SearchResultRegistry,
+        multi_modal_cache: dict,
+        figure_preprocessor: FigurePreprocessor = FIGURE_PREPROCESSOR,
+        context_token_budget: int = None,
+        context_packer: ContextPacker = CONTEXT_PACKER,
     ):
         super().__init__(
             name=name,
@@ -29,47 +46,151 @@ class VisualAgent(AssistantAgent):
         )
 
         self.chunk_and_figure_pairs = chunk_and_figure_pairs
+        self.search_results = search_results
+        self.figure_preprocessor = figure_preprocessor
+        # (source, tool result) -> chunk candidates, shared by the answer agents
+        # in a conversation
+        self.multi_modal_cache = multi_modal_cache
+
+        if context_token_budget is None:
+            context_token_budget = token_budget(name)
+        self.context_token_budget = context_token_budget
+        self.context_packer = context_packer
+        self.last_packing_report: PackingReport | None = None
+
+    async def tool_result_candidates(
+        self, source: str, ai_search_results: str
+    ) -> list[ChunkCandidate]:
+        """Read the chunk candidates of a search tool result, reusing earlier reads.
+
+        The candidates are packed again every turn, so each agent honours its own
+        figure selection and budget.
+
+        Args:
+            source (str): The agent that made the tool call.
+            ai_search_results (str): The tool call result.
+
+        Returns:
+            list[ChunkCandidate]: The chunks and their figures.
+
+        Raises:
+            json.JSONDecodeError: If the result is not a search result payload."""
+        key = (source, ai_search_results)
+
+        candidates = self.multi_modal_cache.get(key)
+        if candidates is None:
+            # Read results another worker retrieved before converting them
+            results = await self.search_results.load(ai_search_results)
+            for chunk_id in results:
+                await self.chunk_and_figure_pairs.load_chunk(chunk_id)
+
+            candidates = self.multi_modal_cache[key] = await self.chunk_candidates(
+                ai_search_results
+            )
+
+        return candidates
+
+    def convert_tool_result(
+        self, source: str, packed_chunks: list[PackedChunk]
+    ) -> MultiModalMessage | None:
+        """Convert the packed chunks of a search tool result into a multimodal message.
+
+        Args:
+            source (str): The agent that made the tool call.
+            packed_chunks (list[PackedChunk]): The chunks packed from the result.
+
+        Returns:
+            MultiModalMessage | None: The message, or None if nothing was packed."""
+        multi_modal_content = []
+        for packed_chunk in packed_chunks:
+            multi_modal_content.append(packed_chunk.text)
+            multi_modal_content.extend(packed_chunk.images)
+
+        multi_modal_message = None
+        if len(multi_modal_content) > 0:
+            logging.info("Sending multimodal message")
+            logging.info("Sending %i messages", len(multi_modal_content))
+            multi_modal_message = MultiModalMessage(
+                content=multi_modal_content, source=source
+            )
+
+        return multi_modal_message
+
+    async def chunk_candidates(self, ai_search_results: str) -> list[ChunkCandidate]:
+        """Read the chunks and their figures from a search tool result.
+
+        Raises:
+            json.JSONDecodeError: If the result is not a search result payload."""
+        results = self.search_results.lookup(ai_search_results)
+        candidates = []
+        for chunk_id, result in results.items():
+            cleaned_text, chunk_image_retrievals = await get_figures_from_chunk(
+                self.chunk_and_figure_pairs,
+                result.chunk,
+                chunk_id=chunk_id,
+                cast_to_chainlit_image=False,
+            )
+            candidates.append(
+                ChunkCandidate(
+                    chunk_id,
+                    cleaned_text,
+                    result.reranker_score,
+                    chunk_image_retrievals,
+                )
+            )
+
+        return candidates
 
     async def on_messages_stream(
         self, messages: Sequence[ChatMessage], cancellation_token: CancellationToken
     ) -> AsyncGenerator[AgentEvent | Response, None]:
         # Override and insert the multimodal messages into the context here. This is a work around as AutoGen doesn't support multi-modal tool call responses yet.
 
-        multi_modal_messages = []
-        for message in messages:
+        # Downscaled, de-duplicated and capped figures for this turn
+        figure_selection = self.figure_preprocessor.select()
+        packing_report = PackingReport(self.context_token_budget)
+
+        # Read every tool result first, so the budget goes to the best chunks of
+        # the whole turn rather than to the earliest results
+        tool_results = {}
+        for index, message in enumerate(messages):
             if isinstance(message, ToolCallExecutionEvent):
                 try:
-                    ai_search_results = message.content[0].content
-                    results = json.loads(ai_search_results)
-                    multi_modal_content = []
-                    for chunk_id, result in results.items():
-                        cleaned_text, chunk_image_retrievals = get_figures_from_chunk(
-                            self.chunk_and_figure_pairs,
-                            result["Chunk"],
-                            chunk_id=chunk_id,
-                        )
-
-                        multi_modal_content.append(cleaned_text)
-
-                        for image in chunk_image_retrievals:
-                            multi_modal_content.append(Image.from_base64(image))
-
-                    if len(multi_modal_content) > 0:
-                        logging.info("Sending multimodal message")
-                        logging.info("Sending %i messages", len(multi_modal_content))
-                        multi_modal_messages.append(
-                            MultiModalMessage(content=multi_modal_content)
-                        )
+                    tool_results[index] = await self.tool_result_candidates(
+                        message.source, message.content[0].content
+                    )
                 except json.JSONDecodeError:
-                    multi_modal_messages.append(message)
+                    pass
+
+        packed_results = dict(
+            zip(
+                tool_results,
+                await self.context_packer.pack(
+                    list(tool_results.values()), figure_selection, packing_report
+                ),
+            )
+        )
 
+        multi_modal_messages = []
+        for index, message in enumerate(messages):
+            if index in packed_results:
+                multi_modal_message = self.convert_tool_result(
+                    message.source, packed_results[index]
+                )
+                if multi_modal_message is not None:
+                    multi_modal_messages.append(multi_modal_message)
             else:
                 multi_modal_messages.append(message)
 
+        if figure_selection.dropped > 0:
+            logging.info("Dropped %i figures", figure_selection.dropped)
+        logging.info("Context for %s: %s", self.name, packing_report)
+        self.last_packing_report = packing_report
+
         async for event in super().on_messages_stream(
             multi_modal_messages, cancellation_token
         ):
             yield event
 
     async def on_reset(self, cancellation_token: CancellationToken) -> None:
-        pass
+        await super().on_reset(cancellation_token)